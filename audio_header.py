@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import argparse
+import subprocess
+
+
+mp3_bitrates = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384,
+             416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320,
+             384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256,
+             320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224,
+             256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+mp3_sample_rates = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000]
+}
+mp3_versions = {0: 2.5, 2: 2, 3: 1}
+mp3_layer_codecs = {1: 'mp1', 2: 'mp2', 3: 'mp3'}
+wav_codecs = {1: 'pcm_{}le', 3: 'pcm_f{}le', 6: 'pcm_alaw', 7: 'pcm_mulaw'}
+mp4_codecs = {b'mp4a': 'aac', b'alac': 'alac', b'ac-3': 'ac3',
+              b'ec-3': 'eac3', b'Opus': 'opus', b'fLaC': 'flac',
+              b'.mp3': 'mp3'}
+mp4_sound_entry_sizes = {0: 36, 1: 52, 2: 72}
+mp4_containers = [b'moov', b'trak', b'mdia', b'minf', b'stbl']
+header_size = 16384
+max_moov_size = 8 * 1024 * 1024
+
+
+def round_duration(seconds):
+    return round(seconds, 6)
+
+
+def parse_mp3_frame_header(data, offset):
+    if offset + 4 > len(data):
+        return None
+    b1, b2, b3 = data[offset + 1], data[offset + 2], data[offset + 3]
+    if data[offset] != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = mp3_versions.get((b1 >> 3) & 0x03)
+    layer = 4 - ((b1 >> 1) & 0x03)
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0x03
+    if version is None or layer == 4 or bitrate_index in (0, 15) \
+            or sample_rate_index == 3:
+        return None
+    bitrate = mp3_bitrates[(min(version, 2), layer)][bitrate_index] * 1000
+    sample_rate = mp3_sample_rates[version][sample_rate_index]
+    padding = (b2 >> 1) & 0x01
+    # a cleared protection bit means a 16 bit CRC follows the header
+    crc = 0 if b1 & 0x01 else 2
+    channels = 1 if (b3 >> 6) == 3 else 2
+    if layer == 1:
+        samples = 384
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+    elif layer == 2 or version == 1:
+        samples = 1152
+        frame_length = 144 * bitrate // sample_rate + padding
+    else:
+        samples = 576
+        frame_length = 72 * bitrate // sample_rate + padding
+    return {'version': version, 'layer': layer, 'bit_rate': bitrate,
+            'sample_rate': sample_rate, 'channels': channels,
+            'samples': samples, 'frame_length': frame_length, 'crc': crc}
+
+
+def find_mp3_frame(data, offset):
+    while True:
+        offset = data.find(b'\xff', offset)
+        if offset < 0:
+            return None, None
+        frame = parse_mp3_frame_header(data, offset)
+        if frame is not None:
+            next_offset = offset + frame['frame_length']
+            if next_offset + 4 > len(data) \
+                    or parse_mp3_frame_header(data, next_offset) is not None:
+                return offset, frame
+        offset += 1
+
+
+def read_mp3_header(fp, file_size):
+    data = fp.read(10)
+    audio_start = 0
+    if data[:3] == b'ID3' and len(data) == 10:
+        size = 0
+        for byte in data[6:10]:
+            size = (size << 7) | (byte & 0x7F)
+        audio_start = 10 + size + (10 if data[5] & 0x10 else 0)
+    fp.seek(audio_start)
+    data = fp.read(header_size)
+    offset, frame = find_mp3_frame(data, 0)
+    if frame is None:
+        return None
+    audio_start += offset
+    audio_end = file_size
+    if file_size >= 128:
+        fp.seek(file_size - 128)
+        if fp.read(3) == b'TAG':
+            audio_end -= 128
+
+    if frame['version'] == 1:
+        side_info = 17 if frame['channels'] == 1 else 32
+    else:
+        side_info = 9 if frame['channels'] == 1 else 17
+    frames = None
+    audio_bytes = audio_end - audio_start
+    xing = offset + 4 + frame['crc'] + side_info
+    if data[xing:xing + 4] in (b'Xing', b'Info'):
+        flags = struct.unpack('>I', data[xing + 4:xing + 8])[0]
+        position = xing + 8
+        if flags & 0x01:
+            frames = struct.unpack('>I', data[position:position + 4])[0]
+            position += 4
+        if flags & 0x02:
+            audio_bytes = struct.unpack('>I', data[position:position + 4])[0]
+    elif data[offset + 36:offset + 40] == b'VBRI':
+        # version, delay and quality come before the byte and frame counts
+        audio_bytes, frames = struct.unpack(
+                '>II', data[offset + 46:offset + 54])
+
+    if frames:
+        duration = frames * frame['samples'] / frame['sample_rate']
+        bit_rate = int(audio_bytes * 8 / duration) if duration else None
+    else:
+        duration = audio_bytes * 8 / frame['bit_rate']
+        bit_rate = frame['bit_rate']
+    return {'duration': round_duration(duration), 'bit_rate': bit_rate,
+            'sample_rate': frame['sample_rate'],
+            'codec_name': mp3_layer_codecs[frame['layer']],
+            'channels': frame['channels']}
+
+
+def read_wav_header(fp, file_size):
+    data = fp.read(12)
+    if len(data) < 12 or data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return None
+    fmt = None
+    position = 12
+    while position + 8 <= file_size:
+        fp.seek(position)
+        chunk_id, chunk_size = struct.unpack('<4sI', fp.read(8))
+        if chunk_id == b'fmt ':
+            fmt_data = fp.read(chunk_size)
+            fmt = list(struct.unpack('<HHIIHH', fmt_data[:16]))
+            if fmt[0] == 0xFFFE and len(fmt_data) >= 26:
+                fmt[0] = struct.unpack('<H', fmt_data[24:26])[0]
+        elif chunk_id == b'data' and fmt is not None:
+            audio_format, channels, sample_rate, byte_rate, _, bits = fmt
+            if not byte_rate:
+                return None
+            data_size = min(chunk_size, file_size - position - 8)
+            codec = wav_codecs.get(audio_format)
+            if audio_format == 1 and bits == 8:
+                codec = 'pcm_u8'
+            elif codec is not None and '{}' in codec:
+                codec = codec.format(
+                        ('s' if audio_format == 1 else '') + str(bits))
+            return {'duration': round_duration(data_size / byte_rate),
+                    'bit_rate': byte_rate * 8, 'sample_rate': sample_rate,
+                    'codec_name': codec, 'channels': channels}
+        position += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+
+def iter_mp4_atoms(data, start, end):
+    position = start
+    while position + 8 <= end:
+        size, kind = struct.unpack('>I4s', data[position:position + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', data[position + 8:position + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - position
+        if size < header:
+            return
+        yield kind, position + header, min(position + size, end)
+        position += size
+
+
+def read_mp4_duration(data, start):
+    if data[start] == 1:
+        timescale, duration = struct.unpack(
+                '>IQ', data[start + 20:start + 32])
+    else:
+        timescale, duration = struct.unpack(
+                '>II', data[start + 12:start + 20])
+    if not timescale:
+        return None
+    return duration / timescale
+
+
+def read_mp4_esds_bitrate(data, start, end):
+    position = start + 4
+    while position < end:
+        tag = data[position]
+        position += 1
+        length = 0
+        for _ in range(4):
+            byte = data[position]
+            position += 1
+            length = (length << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                break
+        if tag == 0x03:
+            flags = data[position + 2]
+            position += 3
+            if flags & 0x80:
+                position += 2
+            if flags & 0x40:
+                position += 1 + data[position]
+            if flags & 0x20:
+                position += 2
+        elif tag == 0x04:
+            avg_bitrate = struct.unpack(
+                    '>I', data[position + 9:position + 13])[0]
+            return avg_bitrate or None
+        else:
+            position += length
+    return None
+
+
+def read_mp4_track(data, start, end, info):
+    handler = None
+    track = {}
+    stack = [(start, end)]
+    while stack:
+        atom_start, atom_end = stack.pop()
+        for kind, child_start, child_end in iter_mp4_atoms(
+                data, atom_start, atom_end):
+            if kind in mp4_containers:
+                stack.append((child_start, child_end))
+            elif kind == b'hdlr':
+                handler = data[child_start + 8:child_start + 12]
+            elif kind == b'mdhd':
+                track['duration'] = read_mp4_duration(data, child_start)
+            elif kind == b'stsd':
+                entry = child_start + 8
+                codec = data[entry + 4:entry + 8]
+                track['codec_name'] = mp4_codecs.get(codec)
+                track['channels'] = struct.unpack(
+                        '>H', data[entry + 24:entry + 26])[0]
+                track['sample_rate'] = struct.unpack(
+                        '>I', data[entry + 32:entry + 36])[0] >> 16
+                version = struct.unpack('>H', data[entry + 16:entry + 18])[0]
+                if version == 2:
+                    track['sample_rate'] = int(struct.unpack(
+                        '>d', data[entry + 40:entry + 48])[0])
+                    track['channels'] = struct.unpack(
+                        '>I', data[entry + 48:entry + 52])[0]
+                entry_size = struct.unpack('>I', data[entry:entry + 4])[0]
+                for sub, sub_start, sub_end in iter_mp4_atoms(
+                        data, entry + mp4_sound_entry_sizes.get(version, 36),
+                        entry + entry_size):
+                    if sub == b'esds':
+                        track['bit_rate'] = read_mp4_esds_bitrate(
+                                data, sub_start, sub_end)
+    if handler == b'soun' and 'channels' in track \
+            and info.get('channels') is None:
+        info.update(track)
+
+
+def read_mp4_header(fp, file_size):
+    position = 0
+    moov = None
+    while position + 8 <= file_size:
+        fp.seek(position)
+        header = fp.read(16)
+        size, kind = struct.unpack('>I4s', header[:8])
+        if size == 1:
+            size = struct.unpack('>Q', header[8:16])[0]
+        elif size == 0:
+            size = file_size - position
+        if size < 8 or (position == 0 and kind != b'ftyp'):
+            return None
+        if kind == b'moov':
+            if size > max_moov_size:
+                return None
+            fp.seek(position)
+            moov = fp.read(size)
+            break
+        position += size
+    if moov is None:
+        return None
+
+    info = dict.fromkeys(['duration', 'bit_rate', 'sample_rate',
+                          'codec_name', 'channels'])
+    movie_duration = None
+    for kind, start, end in iter_mp4_atoms(moov, 8, len(moov)):
+        if kind == b'mvhd':
+            movie_duration = read_mp4_duration(moov, start)
+        elif kind == b'trak':
+            read_mp4_track(moov, start, end, info)
+    if info['channels'] is None:
+        return None
+    if movie_duration:
+        info['duration'] = movie_duration
+    if not info['duration']:
+        return None
+    info['duration'] = round_duration(info['duration'])
+    return info
+
+
+header_readers = {
+    '.mp3': read_mp3_header,
+    '.wav': read_wav_header,
+    '.m4a': read_mp4_header,
+    '.mp4': read_mp4_header
+}
+
+
+def read_audio_header(audio_file):
+    reader = header_readers.get(os.path.splitext(audio_file)[1].lower())
+    if reader is None:
+        return None
+    try:
+        with open(audio_file, 'rb') as fp:
+            return reader(fp, os.fstat(fp.fileno()).st_size)
+    except (OSError, struct.error, IndexError, ZeroDivisionError):
+        return None
+
+
+def generate_fixtures(directory):
+    os.makedirs(directory, exist_ok=True)
+    source = ['-f', 'lavfi', '-i', 'sine=frequency=440:duration=7.3']
+    fixtures = {
+        'cbr_128k.mp3': ['-c:a', 'libmp3lame', '-b:a', '128k'],
+        'cbr_64k_mono_22k.mp3': ['-c:a', 'libmp3lame', '-b:a', '64k',
+                                 '-ac', '1', '-ar', '22050'],
+        'vbr_q2.mp3': ['-c:a', 'libmp3lame', '-q:a', '2'],
+        'vbr_noxing.mp3': ['-c:a', 'libmp3lame', '-q:a', '4',
+                           '-write_xing', '0'],
+        'pcm_s16.wav': ['-c:a', 'pcm_s16le'],
+        'pcm_s24_mono.wav': ['-c:a', 'pcm_s24le', '-ac', '1',
+                             '-ar', '48000'],
+        'aac_128k.m4a': ['-c:a', 'aac', '-b:a', '128k'],
+        'aac_faststart.mp4': ['-c:a', 'aac', '-b:a', '96k',
+                              '-movflags', '+faststart']
+    }
+    files = []
+    for name, options in fixtures.items():
+        output = os.path.join(directory, name)
+        subprocess.run(['ffmpeg', '-v', 'error', '-y'] + source + options
+                       + [output], check=True)
+        files.append(output)
+    return files
+
+
+def vbr_fixture(directory, tag='VBRI', frames=1000):
+    # ffmpeg writes neither VBRI headers nor CRC protected frames, these are
+    # VBR files of alternating 128k and 192k frames after a 128k VBRI frame,
+    # or after a Xing frame with a CRC
+    os.makedirs(directory, exist_ok=True)
+    b1 = b'\xfb' if tag == 'VBRI' else b'\xfa'
+    frame_128k = (b'\xff' + b1 + b'\x90\x00').ljust(417, b'\0')
+    frame_192k = (b'\xff' + b1 + b'\xb0\x00').ljust(626, b'\0')
+    audio = b''.join(frame_192k if i % 2 else frame_128k
+                     for i in range(frames))
+    audio_bytes = 417 + len(audio)
+    if tag == 'VBRI':
+        header = b'\xff\xfb\x90\x00' + bytes(32) + struct.pack(
+                '>4sHHHIIHHHH', b'VBRI', 1, 1105, 75, audio_bytes, frames,
+                0, 1, 4, 1)
+        name = 'vbri.mp3'
+    else:
+        # the CRC comes before the side info
+        header = b'\xff\xfa\x90\x00' + bytes(2 + 32) + struct.pack(
+                '>4sIII', b'Xing', 0x03, frames, audio_bytes)
+        name = 'xing_crc.mp3'
+    header = header.ljust(417, b'\0')
+    output = os.path.join(directory, name)
+    with open(output, 'wb') as fp:
+        fp.write(header + audio)
+    duration = frames * 1152 / 44100
+    return output, {'duration': round_duration(duration),
+                    'bit_rate': int(audio_bytes * 8 / duration),
+                    'sample_rate': 44100, 'codec_name': 'mp3',
+                    'channels': 2}
+
+
+def compare_with_ffprobe(audio_file, duration_tolerance=0.05,
+                         bitrate_tolerance=0.02, expected=None):
+    from probe_cache import probe_file
+    if expected is None:
+        expected = probe_file(audio_file)
+    result = read_audio_header(audio_file)
+    if result is None:
+        return ['not parsed']
+    errors = []
+    for key in ('sample_rate', 'channels', 'codec_name'):
+        if result[key] != expected[key]:
+            errors.append('{}: {} != {}'.format(
+                key, result[key], expected[key]))
+    if expected['duration'] is not None and abs(
+            result['duration'] - expected['duration']) > duration_tolerance:
+        errors.append('duration: {} != {}'.format(
+            result['duration'], expected['duration']))
+    if expected['bit_rate'] and result['bit_rate'] and abs(
+            result['bit_rate'] - expected['bit_rate']) \
+            > expected['bit_rate'] * bitrate_tolerance:
+        errors.append('bit_rate: {} != {}'.format(
+            result['bit_rate'], expected['bit_rate']))
+    return errors
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='audio header',
+            description='Read duration, bitrate and sample rate from .mp3, '
+            '.wav, .m4a and .mp4 headers without ffprobe', epilog='')
+    parser.add_argument('files', nargs='*', help='Audio files')
+    parser.add_argument('--compare', action='store_true',
+                        help='Compare parsed values against ffprobe')
+    parser.add_argument('--generate', metavar='DIRECTORY', default=None,
+                        help='Generate fixture files with ffmpeg and '
+                        'compare them against ffprobe')
+    args = parser.parse_args()
+
+    try:
+        files = list(args.files)
+        expected = {}
+        if args.generate is not None:
+            # the handcrafted fixtures are checked against their own values
+            for tag in ('VBRI', 'Xing'):
+                file, expected[file] = vbr_fixture(args.generate, tag)
+                files.append(file)
+            files = files + generate_fixtures(args.generate)
+        failed = 0
+        for file in files:
+            if args.compare or args.generate is not None:
+                errors = compare_with_ffprobe(file,
+                                              expected=expected.get(file))
+                failed += bool(errors)
+                print('FAIL' if errors else 'OK  ', file, *errors)
+            else:
+                print(read_audio_header(file), file)
+        if failed:
+            raise SystemExit(1)
+    except KeyboardInterrupt:
+        print('Program interrupted')
+        raise SystemExit(0)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import atexit
+import socket
+import argparse
+import selectors
+
+
+commands = ['status', 'skip', 'pause', 'resume', 'stop', 'enqueue', 'gain',
+            'reload']
+
+
+class ControlRequest:
+
+    def __init__(self, server, client, command, argument=None,
+                 request_id=None):
+        self.server = server
+        self.client = client
+        self.command = command
+        self.argument = argument
+        self.request_id = request_id
+
+    def reply(self, ok=True, **fields):
+        response = {'ok': ok, 'cmd': self.command}
+        if self.request_id is not None:
+            response['id'] = self.request_id
+        response.update(fields)
+        self.server.send(self.client, response)
+
+
+def parse_request(line):
+    # "gain 0.8" or {"cmd": "gain", "arg": 0.8, "id": 1}
+    line = line.strip()
+    if line.startswith('{'):
+        data = json.loads(line)
+        if not isinstance(data, dict):
+            raise ValueError('Expected a JSON object')
+        argument = data.get('arg')
+        # commands only get strings, numbers or nothing, true is an int
+        if isinstance(argument, bool) \
+                or not isinstance(argument, (str, int, float, type(None))):
+            raise ValueError('"arg" must be a string or a number')
+        return str(data.get('cmd', '')).lower(), argument, data.get('id')
+    command, _, argument = line.partition(' ')
+    return command.lower(), argument.strip() or None, None
+
+
+class ControlServer:
+
+    def __init__(self, socket_path, mode=0o660, max_line=65536):
+        self.socket_path = socket_path
+        self.max_line = max_line
+        self.requests = 0
+        self._clients = {}
+        self._selector = selectors.DefaultSelector()
+        self.__remove_stale()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(socket_path)
+        os.chmod(socket_path, mode)
+        self._socket.listen(8)
+        self._socket.setblocking(False)
+        self._selector.register(self._socket, selectors.EVENT_READ, None)
+        atexit.register(self.close)
+
+    def __remove_stale(self):
+        if not os.path.exists(self.socket_path):
+            return None
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(self.socket_path)
+            return None
+        finally:
+            probe.close()
+        raise RuntimeError('"{}" is used by another musicplayer'.format(
+            self.socket_path))
+
+    def fileno(self):
+        # the epoll fd is readable while a client or the listener is, so
+        # the player's selector wakes up on commands
+        return self._selector.fileno()
+
+    def wait(self, timeout=None):
+        self._selector.select(timeout)
+
+    def __accept(self):
+        while True:
+            try:
+                client, _ = self._socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return None
+            # replies are small, a blocking send with a timeout keeps a
+            # stuck client from stalling playback for long
+            client.settimeout(1.0)
+            self._clients[client] = b''
+            self._selector.register(client, selectors.EVENT_READ, 'client')
+
+    def __drop(self, client):
+        if client not in self._clients:
+            return None
+        del self._clients[client]
+        self._selector.unregister(client)
+        client.close()
+
+    def __read(self, client):
+        try:
+            data = client.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self.__drop(client)
+            return []
+        buffer = self._clients[client] + data
+        *lines, buffer = buffer.split(b'\n')
+        if len(buffer) > self.max_line:
+            self.__drop(client)
+            return []
+        self._clients[client] = buffer
+        requests = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                command, argument, request_id = parse_request(
+                        line.decode('utf-8'))
+            except ValueError as e:
+                self.send(client, {'ok': False, 'error': str(e)})
+                continue
+            requests.append(ControlRequest(
+                self, client, command, argument, request_id))
+        return requests
+
+    def serve(self):
+        requests = []
+        for key, _ in self._selector.select(0):
+            if key.data is None:
+                self.__accept()
+            else:
+                requests.extend(self.__read(key.fileobj))
+        self.requests += len(requests)
+        return requests
+
+    def send(self, client, response):
+        try:
+            client.sendall((json.dumps(response, separators=(',', ':'))
+                            + '\n').encode('utf-8'))
+        except OSError:
+            self.__drop(client)
+
+    def close(self):
+        if self._socket is None:
+            return None
+        for client in list(self._clients):
+            self.__drop(client)
+        self._selector.close()
+        self._socket.close()
+        self._socket = None
+        try:
+            os.remove(self.socket_path)
+        except OSError:
+            pass
+
+
+def send_command(socket_path, command, argument=None, timeout=5.0):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_path)
+        request = {'cmd': command}
+        if argument is not None:
+            request['arg'] = argument
+        client.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        client.close()
+    return json.loads(data.decode('utf-8'))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='control',
+            description='Send a command to musicplayer --control SOCKET',
+            epilog='')
+    parser.add_argument('socket', type=str, help='Control socket')
+    parser.add_argument('command', choices=commands)
+    parser.add_argument('argument', nargs='?', default=None,
+                        help='Track for enqueue, gain for gain')
+    args = parser.parse_args()
+
+    try:
+        response = send_command(args.socket, args.command, args.argument)
+        print(json.dumps(response, indent=2))
+        if not response.get('ok'):
+            raise SystemExit(1)
+    except KeyboardInterrupt:
+        print('Program interrupted')
+        raise SystemExit(0)
+    except Exception as e:
+        print('Exception encountered:', e)
+        raise SystemExit(1)
@@ -1,12 +1,17 @@
 #!/usr/bin/env python3
 
 import os
-import subprocess
 import time
 from musicplayer import get_audio_files as get_files
 from musicplayer import print_to_file
+from library_index import list_files
 import argparse
-from threading import Thread
+from probe_cache import ProbeCache
+from job_scheduler import Job, JobScheduler, format_job
+from convert_manifest import ConvertManifest, file_hash, temp_output
+from transcode_cache import TranscodeCache
+from loudness import LoudnessCache, measure_command, read_measurement
+from loudness import filter_graph, encode_command
 
 
 def my_print(*args, **kwargs):
@@ -25,37 +30,13 @@ def remove_empty_directories(*directories):
 
 
 def get_bitrate_or_samplerate_int(stream_opt, audio_file):
-    result = subprocess.run([
-        'ffprobe',
-        '-v',
-        'error',
-        '-select_streams',
-        'a:0',
-        '-show_entries',
-        'stream='+str(stream_opt),
-        '-of',
-        'default=noprint_wrappers=1:nokey=1',
-        audio_file
-    ], capture_output=True, text=True)
-    return int(result.stdout)
+    return int(probe_cache.get(audio_file)[stream_opt])
 
 
 def get_bitrate_and_samplerate_raw(audio_file):
-    result = subprocess.run([
-        'ffprobe',
-        '-v',
-        'error',
-        '-select_streams',
-        'a:0',
-        '-show_entries',
-        'stream=bit_rate',
-        '-show_entries',
-        'stream=sample_rate',
-        '-of',
-        'default=noprint_wrappers=1:nokey=1',
-        audio_file
-    ], capture_output=True, text=True)
-    return result.stdout
+    info = probe_cache.get(audio_file)
+    return ''.join('{}\n'.format('N/A' if info[key] is None else info[key])
+                   for key in ('sample_rate', 'bit_rate'))
 
 
 def print_bitrate_info(audio_file):
@@ -64,40 +45,18 @@ def print_bitrate_info(audio_file):
 
 
 def get_audio_file_duration(audio_file):
-    result = subprocess.run([
-        'ffprobe',
-        '-v',
-        'error',
-        '-show_entries',
-        'format=duration',
-        '-of',
-        'default=noprint_wrappers=1:nokey=1',
-        audio_file
-    ], capture_output=True, text=True)
-    duration = float(result.stdout)
-    return duration
-
-
-def normalize_files(input_file, output_file, mode):
-    return subprocess.Popen([
-        'ffmpeg-normalize',
-        input_file,
-        '-nt',
-        mode,
-        '-c:a',
-        'libmp3lame',
-        '-b:a',
-        '128k',
-        '-ext',
-        'mp3',
-        '-o',
-        output_file
-    ], stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+    return probe_cache.get_duration(audio_file)
+
+
+def normalize_files(input_file, output_file, measurement):
+    # a single encode with the linear gain of the stored measurement
+    return encode_command(input_file, output_file, filter_graph(
+        measurement, normalized_mode, target_level), bitrate)
 
 
 def audio_fade(input_file, output_file, fade_in_sec=2, fade_out_sec=2):
     duration = get_audio_file_duration(input_file)
-    return subprocess.Popen([
+    return [
         'ffmpeg',
         '-i',
         input_file,
@@ -106,53 +65,145 @@ def audio_fade(input_file, output_file, fade_in_sec=2, fade_out_sec=2):
         ',afade=out:st='+str(duration-fade_out_sec)+':d='+str(fade_out_sec),
         output_file,
         '-n'
-    ], stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+    ]
 
 
 def convert_files(input_file, output_file):
-    return subprocess.Popen([
+    return [
         'ffmpeg',
         '-i',
         input_file,
         output_file,
         '-n'
-    ], stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+    ]
+
+
+def pipeline_files(input_file, output_file, measurement):
+    # gain, fades and bitrate in one filter graph and one encode
+    mode = None if normalized_mode == 'none' else normalized_mode
+    if measurement is None:
+        # -m none only needs the duration for the fade-out, which the probe
+        # cache reads from the header without a decode
+        measurement = {'duration': get_audio_file_duration(input_file)}
+    return encode_command(input_file, output_file, filter_graph(
+        measurement, mode, target_level, fade_in, fade_out), bitrate)
 
 
 def scan_audio_files(audio_files):
-    thread_list = []
-    proc_list = []
-    for file in audio_files:
-        thread = Thread(target=print_bitrate_info, args=(file,))
-        thread_list.append(thread)
-        thread.start()
-        for thread in thread_list:
-            proc_list = [p for p in thread_list if p.is_alive()]
-            while (len(proc_list) > subprocess_limit - 1):
-                proc_list = [p for p in thread_list if p.is_alive()]
-                time.sleep(0.01)
-        thread_list[:] = [p for p in proc_list if p.is_alive()]
-
-    for thread in thread_list:
-        thread.join()
-
-
-def select_func(input_file, output_file):
+    jobs = (Job(target=print_bitrate_info, args=(file,), data=file)
+            for file in audio_files)
+    for job in scheduler.run(jobs):
+        if job.error is not None:
+            print('Exception encountered:', job.error, job.data)
+        elif verbose > 2:
+            my_print(format_job(job, job.data))
+
+
+def select_func(input_file, output_file, measurement=None):
     if directory == 'output_files':
         return convert_files(input_file, output_file)
     elif directory == 'fade':
         return audio_fade(input_file, output_file, fade_in, fade_out)
-    return normalize_files(input_file, output_file, normalized_mode)
+    elif directory == 'pipeline':
+        return pipeline_files(input_file, output_file, measurement)
+    return normalize_files(input_file, output_file, measurement)
+
+
+def get_output_file(input_file):
+    return os.path.join(target_directory,
+                        os.path.splitext(input_file)[0]+'.mp3')
+
+
+def create_job(f, output, source_hash=None):
+    if source_hash is None:
+        # the source is read in a thread job, hash_finished submits the
+        # next stage, so hashing overlaps with the running encodes
+        return Job(target=file_hash, args=(f,), data=(f, output, None, None))
+    temp_file = temp_output(output)
+    command = None
+    if directory not in measured_directories:
+        command = select_func(f, temp_file)
+    key = None
+    if transcode_cache is not None:
+        # the same content encoded with the same arguments was already
+        # converted for another directory or run, link it instead
+        if command is None:
+            # the gain follows from the content and the settings
+            parameters = settings
+        else:
+            parameters = ['{input}' if a == f else '{output}'
+                          if a == temp_file else a for a in command]
+        key = transcode_cache.key(source_hash, parameters)
+        if transcode_cache.contains(key):
+            return Job(target=transcode_cache.fetch, args=(key, temp_file),
+                       data=(f, output, source_hash, key))
+    if command is None:
+        measurement = loudness_cache.lookup(loudness_cache.key(f, source_hash))
+        if measurement is None:
+            # measured first, measure_finished submits the encode, so
+            # measurements overlap with the encodes of other files
+            measure_log = temp_file + '.log'
+            output_files.append(measure_log)
+            return Job(measure_command(f), stderr=measure_log,
+                       data=(f, output, source_hash, key))
+        command = select_func(f, temp_file, measurement)
+    return Job(command, data=(f, output, source_hash, key))
+
+
+def create_jobs():
+    # ffmpeg writes to a hidden temp file that is renamed once it exits
+    # with 0, an interrupted run leaves no truncated .mp3 behind
+    for f in files:
+        output = get_output_file(f)
+        temp_file = temp_output(output)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        cleanup([temp_file])
+        output_files.append(temp_file)
+        manifest.start(f, output)
+        yield create_job(f, output)
 
 
-def update_completed_files():
-    if enable_log:
-        [print_to_file(
-            log_file, os.path.splitext(p.args[
-                argument_index_list[0]])[0]+'.mp3')
-         for p in process_list if p.poll() == 0]
-    [completed_files.append(p.args[argument_index_list[1]])
-     for p in process_list if p.poll() == 0]
+def hash_finished(job):
+    input_file, output_file, source_hash, key = job.data
+    if job.error is not None:
+        return False
+    scheduler.submit(create_job(input_file, output_file, job.result))
+    return True
+
+
+def measure_finished(job):
+    input_file, output_file, source_hash, key = job.data
+    try:
+        if job.returncode == 0:
+            loudness_cache.store(loudness_cache.key(input_file, source_hash),
+                                 read_measurement(job.stderr))
+            scheduler.submit(create_job(input_file, output_file,
+                                        source_hash))
+            return True
+    except (OSError, ValueError) as e:
+        job.error = e
+    finally:
+        cleanup([job.stderr])
+    return False
+
+
+def update_completed_files(job):
+    input_file, output_file, source_hash, key = job.data
+    if job.error is not None:
+        manifest.fail(input_file, str(job.error))
+    elif job.returncode != 0:
+        manifest.fail(input_file, 'exit {}'.format(job.returncode))
+    elif manifest.commit(input_file, output_file, source_hash):
+        if key is not None and job.command is not None:
+            transcode_cache.store(key, output_file, job.wall_time)
+        if enable_log:
+            print_to_file(log_file, os.path.splitext(input_file)[0]+'.mp3')
+        completed_files.append(output_file)
+    if verbose > 2:
+        my_print(format_job(job, input_file))
+    elif verbose > 0:
+        my_print('Return code: {:3}, Processed file: {}'.format(
+            job.returncode, input_file))
 
 
 def draw_progress_bar(status):
@@ -171,55 +222,45 @@ def draw_progress_bar(status):
 def main():
     start_time = time.time()
     file_count = len(files)
-    completed_file_count = len(completed_files)
     if file_count == 0:
         raise SystemExit('No files found... Raising SystemExit')
 
     my_print('Converting files to .mp3 with {} option...'.format(args.output))
-    files[:] = [f for f in files if os.path.splitext(f)[0]
-                not in [os.path.splitext(p)[0] for p in completed_files]]
-    completed_files[:] = [os.path.join(target_directory, f)
-                          for f in completed_files]
+    completed = set(completed_files)
+    files[:] = [f for f in files if f not in completed]
+    completed_files[:] = [get_output_file(f) for f in completed_files]
     if enable_log:
         [print_to_file(log_file, f) for f in completed_files]
-    for f in files:
-        output = os.path.join(target_directory, os.path.splitext(f)[0]+'.mp3')
-        output_files.append(output)
-        process_list.append(select_func(f, output))
-        if len(process_list) > subprocess_limit - 1:
-            for proc in process_list:
-                status = (((completed_file_count+len(
-                    output_files)-(len(process_list)))/file_count)*100)
-                draw_progress_bar(status)
-                temp_list = [p for p in process_list if p.poll() is None]
-                while (len(temp_list) > subprocess_limit - 1):
-                    temp_list = [p for p in process_list if p.poll() is None]
-                    time.sleep(0.01)
-                if verbose > 0 and proc.poll() is not None:
-                    my_print('Return code: {:3}, Processed file: {}'
-                             .format(proc.returncode,
-                                     proc.args[argument_index_list[0]]))
-            update_completed_files()
-            process_list[:] = [p for p in temp_list if p.poll() is None]
-
-    for proc in process_list:
-        status = (((completed_file_count+len(output_files)-(
-            len(process_list)-process_list.index(proc)))/file_count)*100)
-        draw_progress_bar(status)
-        proc.wait()
-        if verbose > 0 and proc.poll() is not None:
-            my_print('Return code: {:3}, Processed file: {}'
-                     .format(proc.returncode,
-                             proc.args[argument_index_list[0]]))
-    update_completed_files()
+    draw_progress_bar(completed_file_count/file_count*100)
+    processed = completed_file_count
+    # ffmpeg jobs start as soon as one exits, the scheduler blocks on
+    # child exit instead of polling
+    for job in scheduler.run(create_jobs()):
+        if job.stderr is not None and measure_finished(job):
+            continue
+        if job.target is file_hash and hash_finished(job):
+            continue
+        update_completed_files(job)
+        processed += 1
+        if processed < file_count:
+            draw_progress_bar(processed/file_count*100)
 
     draw_progress_bar(100)
     my_print('Completed in {:.2f} seconds'.format(time.time() - start_time))
+    if verbose > 0:
+        passes = sum(job.command is not None for job in scheduler.finished)
+        my_print(scheduler.stats())
+        my_print('Decode passes: {} for {} files ({:.2f} per file)'.format(
+            passes, len(files), passes / max(len(files), 1)))
+        if directory in measured_directories:
+            my_print(loudness_cache.stats())
+        my_print(manifest.stats())
+        if transcode_cache is not None:
+            my_print(transcode_cache.stats())
+        my_print(probe_cache.stats())
     if enable_log:
         print_to_file(log_file, 'Done')
 
-    output_files[:] = [f for f in output_files if f not in completed_files]
-
 
 if __name__ == '__main__':
 
@@ -230,11 +271,19 @@ if __name__ == '__main__':
             prog='convert2mp3',
             description='Convert audio files to .mp3 files', epilog='')
     parser.add_argument('-o', '--output', choices=['default', 'normalized',
-                                                   'fade', 'scan'],
+                                                   'fade', 'pipeline', 'scan'],
                         default='default', help='normalized option: Normalizes'
-                        ' volume on all audio files')
-    parser.add_argument('-m', '--mode', choices=['ebu', 'rms', 'peak'],
-                        default='ebu', help='Normalized modes, default=ebu')
+                        ' volume on all audio files, pipeline option: '
+                        'Normalizes (-m), fades and encodes (-b) in one pass')
+    parser.add_argument('-m', '--mode', choices=['ebu', 'rms', 'peak', 'none'],
+                        default='ebu', help='Normalized modes, none skips '
+                        'normalizing in pipeline, default=ebu')
+    parser.add_argument('-t', '--target', type=float, default=-23.0,
+                        help='Normalized and pipeline target level in LUFS '
+                        '(ebu) or dBFS \"default = -23\"')
+    parser.add_argument('-b', '--bitrate', type=str, default='128k',
+                        help='Normalized and pipeline bitrate \"default = '
+                        '128k\"')
     parser.add_argument('-l', '--limit', type=int, default=cpu_count,
                         help='limit subprocesses spawned')
     parser.add_argument('-c', '--clean', action='store_true',
@@ -242,6 +291,9 @@ if __name__ == '__main__':
                         'interrupting the program')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='Increase verbosity level')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='Convert audio files in subdirectories, keeping '
+                        'the directory layout in the target directory')
     parser.add_argument('--fade-in', type=float, default=2.00,
                         help='Fade-in (seconds). \"default = 2.00\"')
     parser.add_argument('--fade-out', type=float, default=2.00,
@@ -250,7 +302,21 @@ if __name__ == '__main__':
                         help='Log program output to convert2mp3.log')
     parser.add_argument('--rename-log', type=str, default='convert2mp3.log',
                         help='Rename log file')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Transcode cache, on the filesystem of the '
+                        'target directories for reflinks and hard links '
+                        '"default = transcode_cache next to the scripts"')
+    parser.add_argument('--cache-size', type=int, default=0, metavar='MB',
+                        help='Keep up to MB of outputs in the transcode '
+                        'cache, each output is also copied there unless '
+                        'reflinks work "default = 0, disabled"')
+    parser.add_argument('--cache-hardlink', action='store_true',
+                        help='Hard link cached outputs where reflinks are '
+                        'not supported, outputs then share the cache '
+                        'object and must not be edited in place')
     args = parser.parse_args()
+    if args.output == 'normalized' and args.mode == 'none':
+        parser.error('-m none is only valid with -o pipeline')
 
     verbose = args.verbose
     subprocess_limit = abs(args.limit)
@@ -258,11 +324,18 @@ if __name__ == '__main__':
         my_print('Maximum subprocess limit is {}'.format(max_subprocess_limit))
         subprocess_limit = max_subprocess_limit
     output_files = []
-    process_list = []
+    scheduler = JobScheduler(subprocess_limit)
+    probe_cache = ProbeCache()
+    transcode_cache = None
+    if args.cache_size > 0:
+        transcode_cache = TranscodeCache(args.cache_dir, args.cache_size << 20,
+                                         args.cache_hardlink)
     supported_files = [".mp3", ".wma", ".m4a", ".webm", ".wav", ".mp4"]
     directory = 'normalized'
     normalized_mode = args.mode
-    argument_index_list = [1, 11]
+    target_level = args.target
+    bitrate = args.bitrate
+    loudness_cache = LoudnessCache()
     fade_in = abs(args.fade_in)
     fade_out = abs(args.fade_out)
     enable_log = args.enable_log
@@ -271,19 +344,32 @@ if __name__ == '__main__':
             os.path.dirname(os.path.abspath(__file__)), log_file_name)
     reset_log_at_startup = True
 
-    files = get_files(os.getcwd(), supported_files)
+    output_directories = ['output_files', 'fade', 'normalized', 'pipeline']
+    # loudness is measured once per source content and kept in loudness.db
+    measured_directories = ['normalized', 'pipeline']
+    if normalized_mode == 'none':
+        measured_directories.remove('pipeline')
+    if args.recursive:
+        files = list_files(os.getcwd(), supported_files, recursive=True,
+                           exclude=output_directories)
+    else:
+        files = get_files(os.getcwd(), supported_files)
 
     if args.output == 'default':
         directory = 'output_files'
-        argument_index_list = [2, 3]
     elif args.output == 'fade':
         directory = 'fade'
-        argument_index_list = [2, 5]
+    elif args.output == 'pipeline':
+        directory = 'pipeline'
     elif args.output == 'scan':
         try:
             scan_audio_files(files)
+            if verbose > 0:
+                my_print(scheduler.stats())
+                my_print(probe_cache.stats())
             raise SystemExit(0)
         except KeyboardInterrupt:
+            scheduler.stop()
             print('Program interrupted')
             raise SystemExit(0)
         except Exception as e:
@@ -305,35 +391,45 @@ if __name__ == '__main__':
     if not os.path.isdir(target_directory):
         os.mkdir(target_directory)
 
-    completed_files = [f for f in files if os.path.splitext(
-        f)[0] in [os.path.splitext(p)[0] for p in get_files(
-            target_directory, supported_files)]]
+    # one manifest entry per source, a rerun skips sources whose output,
+    # settings, size and mtime (or hash) are unchanged
+    settings = {'output': args.output}
+    if args.output == 'normalized':
+        settings.update(mode=normalized_mode, target=target_level,
+                        bitrate=bitrate)
+    elif args.output == 'fade':
+        settings['fade'] = [fade_in, fade_out]
+    elif args.output == 'pipeline':
+        settings.update(mode=normalized_mode, target=target_level,
+                        fade=[fade_in, fade_out], bitrate=bitrate)
+    manifest = ConvertManifest(target_directory, settings,
+                               probe_cache=probe_cache)
+    cleanup(manifest.temp_files())
+    completed_files = [f for f in files
+                       if manifest.is_complete(f, get_output_file(f))]
+    completed_file_count = len(completed_files)
 
     try:
         main()
     except KeyboardInterrupt:
         draw_progress_bar(-1)
         my_print('Program interrupted')
-        for p in process_list:
-            if args.clean:
-                p.terminate()
-            p.wait()
-        update_completed_files()
+        [update_completed_files(job)
+         for job in scheduler.stop(terminate=args.clean)
+         if job.stderr is None and job.target is not file_hash]
         if enable_log:
             print_to_file(log_file, 'Program interrupted')
-        if verbose > 0:
-            [my_print('Return code: {:3}, Processed file: {}'.format(
-                          p.returncode,
-                          p.args[argument_index_list[0]]))
-             for p in process_list if p.poll() is not None]
-        if not args.clean:
-            output_files = [f for f in output_files
-                            if f not in completed_files]
+        if args.clean:
+            output_files += completed_files[completed_file_count:]
         raise SystemExit(0)
     except Exception as e:
         my_print('Exception encountered:', e)
-        output_files = [f for f in output_files if f not in completed_files]
         raise SystemExit(1)
     finally:
+        scheduler.close()
+        manifest.close()
+        if transcode_cache is not None:
+            transcode_cache.close()
+        loudness_cache.close()
         cleanup(output_files)
         remove_empty_directories(target_directory)
@@ -5,6 +5,7 @@ import subprocess
 import time
 from musicplayer import get_audio_files as get_files
 import argparse
+from probe_cache import ProbeCache
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
@@ -18,37 +19,13 @@ def remove_empty_directories(*directories):
 
 
 def get_bitrate_or_samplerate_int(stream_opt, audio_file):
-    result = subprocess.run([
-        'ffprobe',
-        '-v',
-        'error',
-        '-select_streams',
-        'a:0',
-        '-show_entries',
-        'stream='+str(stream_opt),
-        '-of',
-        'default=noprint_wrappers=1:nokey=1',
-        audio_file
-    ], capture_output=True, text=True)
-    return int(result.stdout)
+    return int(probe_cache.get(audio_file)[stream_opt])
 
 
 def get_bitrate_and_samplerate_raw(audio_file):
-    result = subprocess.run([
-        'ffprobe',
-        '-v',
-        'error',
-        '-select_streams',
-        'a:0',
-        '-show_entries',
-        'stream=bit_rate',
-        '-show_entries',
-        'stream=sample_rate',
-        '-of',
-        'default=noprint_wrappers=1:nokey=1',
-        audio_file
-    ], capture_output=True, text=True)
-    return result.stdout
+    info = probe_cache.get(audio_file)
+    return ''.join('{}\n'.format('N/A' if info[key] is None else info[key])
+                   for key in ('sample_rate', 'bit_rate'))
 
 
 def print_bitrate_info(audio_file):
@@ -57,18 +34,7 @@ def print_bitrate_info(audio_file):
 
 
 def get_audio_file_duration(audio_file):
-    result = subprocess.run([
-        'ffprobe',
-        '-v',
-        'error',
-        '-show_entries',
-        'format=duration',
-        '-of',
-        'default=noprint_wrappers=1:nokey=1',
-        audio_file
-    ], capture_output=True, text=True)
-    duration = float(result.stdout)
-    return duration
+    return probe_cache.get_duration(audio_file)
 
 
 def normalize_files(input_file, output_file, mode):
@@ -176,6 +142,8 @@ def main():
                 draw_progress_bar((completed_count/file_count)*100)
 
     print('Completed in {:.2f} seconds'.format(time.time() - start_time))
+    if verbose > 0:
+        print(probe_cache.stats())
 
 
 if __name__ == '__main__':
@@ -212,6 +180,7 @@ if __name__ == '__main__':
     normalized_mode = args.mode
     fade_in = abs(args.fade_in)
     fade_out = abs(args.fade_out)
+    probe_cache = ProbeCache()
 
     files = get_files(os.getcwd(), supported_files)
 
@@ -221,6 +190,8 @@ if __name__ == '__main__':
         directory = 'fade'
     elif args.output == 'scan':
         scan_audio_files(files)
+        if verbose > 0:
+            print(probe_cache.stats())
         raise SystemExit(0)
 
     target_directory = os.path.join(os.getcwd(), directory)
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import hashlib
+import argparse
+from probe_cache import ProbeCache
+
+
+manifest_version = 1
+
+
+def file_hash(filepath, block_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def temp_output(output_file):
+    # hidden, and the extension is kept because ffmpeg picks the output
+    # format from it
+    directory, name = os.path.split(output_file)
+    return os.path.join(directory, '.{}.part{}'.format(
+        *os.path.splitext(name)))
+
+
+def fsync_file(filepath):
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ConvertManifest:
+
+    def __init__(self, target_directory, settings=None, manifest_file=None,
+                 probe_cache=None, duration_tolerance=0.5):
+        self.target_directory = os.path.abspath(target_directory)
+        self.settings = settings or {}
+        self.probe_cache = probe_cache
+        self.duration_tolerance = duration_tolerance
+        if manifest_file is None:
+            manifest_file = os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    'convert_manifest.{}.jsonl'.format(hashlib.sha1(
+                        self.target_directory.encode()).hexdigest()[:12]))
+        self.manifest_file = manifest_file
+        self.entries = {}
+        self.adopted = 0
+        self.rejected = 0
+        self._records = 0
+        self._fd = None
+        self.load()
+        if self._records > 2 * len(self.entries) + 100:
+            self.compact()
+
+    def load(self):
+        # a journal of entry states, the last record of a source wins
+        try:
+            with open(self.manifest_file, 'r', encoding='utf-8') as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn last line of a crash
+                        continue
+                    if 'source' in record:
+                        self.entries[record['source']] = record
+                        self._records += 1
+        except OSError:
+            pass
+
+    def __open(self):
+        new = not os.path.exists(self.manifest_file)
+        self._fd = os.open(self.manifest_file,
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        if new:
+            self.__write({'version': manifest_version,
+                          'target': self.target_directory})
+
+    def __write(self, record):
+        # one write per record keeps lines whole with O_APPEND
+        if self._fd is None:
+            self.__open()
+        os.write(self._fd, (json.dumps(record, separators=(',', ':'))
+                            + '\n').encode('utf-8'))
+
+    def __append(self, source, state, **fields):
+        entry = dict(self.entries.get(source, {}), source=source, state=state,
+                     time=time.time(), **fields)
+        self.entries[source] = entry
+        self.__write(entry)
+        self._records += 1
+        return entry
+
+    def compact(self):
+        temp_file = '{}.{}.tmp'.format(self.manifest_file, os.getpid())
+        with open(temp_file, 'w', encoding='utf-8') as fp:
+            fp.write(json.dumps({'version': manifest_version,
+                                 'target': self.target_directory}) + '\n')
+            for entry in self.entries.values():
+                fp.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp_file, self.manifest_file)
+        self._records = len(self.entries)
+
+    def output_matches(self, source, output_file):
+        # a truncated output of an interrupted run is shorter than its
+        # source
+        if self.probe_cache is None:
+            self.probe_cache = ProbeCache()
+        try:
+            expected = self.probe_cache.get(source)['duration']
+            info = self.probe_cache.get(output_file)
+            size = os.path.getsize(output_file)
+        except (OSError, ValueError):
+            return False
+        duration = info['duration']
+        if expected is None or duration is None \
+                or abs(expected - duration) > self.duration_tolerance:
+            return False
+        # a Xing or VBRI header keeps the full length of a cut file
+        return not info['bit_rate'] \
+            or size >= info['bit_rate'] * duration / 8 * 0.98
+
+    def is_complete(self, source, output_file):
+        source = os.path.abspath(source)
+        entry = self.entries.get(source)
+        if entry is None:
+            # outputs of runs before the manifest existed are kept if they
+            # are as long as their source
+            if not os.path.isfile(output_file):
+                return False
+            if not self.output_matches(source, output_file):
+                self.rejected += 1
+                return False
+            stat = os.stat(source)
+            self.__append(source, 'done', size=stat.st_size,
+                          mtime=stat.st_mtime_ns, hash=None,
+                          output=output_file, settings=self.settings,
+                          output_size=os.path.getsize(output_file))
+            self.adopted += 1
+            return True
+        if entry['state'] != 'done' or entry['output'] != output_file \
+                or entry['settings'] != self.settings:
+            return False
+        try:
+            stat = os.stat(source)
+            if os.path.getsize(output_file) != entry['output_size']:
+                return False
+        except OSError:
+            return False
+        if stat.st_size != entry['size']:
+            return False
+        if stat.st_mtime_ns != entry['mtime']:
+            # touched or copied, the content decides
+            if entry['hash'] is None or file_hash(source) != entry['hash']:
+                return False
+            self.__append(source, 'done', mtime=stat.st_mtime_ns)
+        return True
+
+    def temp_files(self):
+        # partial outputs of jobs that were running when the last run died
+        return [temp_output(entry['output'])
+                for entry in self.entries.values()
+                if entry['state'] == 'started']
+
+    def start(self, source, output_file):
+        stat = os.stat(source)
+        self.__append(os.path.abspath(source), 'started', size=stat.st_size,
+                      mtime=stat.st_mtime_ns, hash=None, output=output_file,
+                      settings=self.settings, output_size=None)
+
+    def commit(self, source, output_file, source_hash=None):
+        # the output appears under its name only when it is complete, the
+        # done record follows the rename
+        temp_file = temp_output(output_file)
+        try:
+            fsync_file(temp_file)
+            os.replace(temp_file, output_file)
+        except OSError as e:
+            self.fail(source, str(e))
+            return False
+        self.__append(os.path.abspath(source), 'done',
+                      hash=source_hash or file_hash(source),
+                      output_size=os.path.getsize(output_file))
+        return True
+
+    def fail(self, source, error):
+        self.__append(os.path.abspath(source), 'failed', error=error)
+
+    def counts(self):
+        counts = {}
+        for entry in self.entries.values():
+            counts[entry['state']] = counts.get(entry['state'], 0) + 1
+        return counts
+
+    def stats(self):
+        return 'Manifest: {}, {} adopted, {} rejected'.format(', '.join(
+            '{} {}'.format(count, state)
+            for state, count in sorted(self.counts().items())) or 'empty',
+            self.adopted, self.rejected)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='convert_manifest',
+            description='Show the resume manifest of a convert2mp3 target '
+            'directory', epilog='')
+    parser.add_argument('target', type=str,
+                        help='Target directory, e.g. output_files')
+    parser.add_argument('-f', '--failed', action='store_true',
+                        help='List failed and unfinished sources')
+    parser.add_argument('--compact', action='store_true',
+                        help='Rewrite the journal with one line per source')
+    args = parser.parse_args()
+
+    try:
+        manifest = ConvertManifest(args.target)
+        print(manifest.manifest_file)
+        print(manifest.stats())
+        if args.failed:
+            [print(entry['state'], entry.get('error', ''), source)
+             for source, entry in sorted(manifest.entries.items())
+             if entry['state'] != 'done']
+        if args.compact:
+            manifest.compact()
+    except KeyboardInterrupt:
+        print('Program interrupted')
+        raise SystemExit(0)
+    except Exception as e:
+        print('Exception encountered:', e)
+        raise SystemExit(1)
@@ -4,7 +4,7 @@ import os
 import argparse
 import pathlib
 from musicplayer import get_file_list
-from musicplayer import get_audio_files
+from library_index import list_files
 
 
 def main():
@@ -15,13 +15,15 @@ def main():
     if original_files.endswith((".txt", ".log")):
         file_list = get_file_list(original_files, supported_audio_files)
     else:
-        file_list = get_audio_files(original_files, supported_audio_files)
+        file_list = list_files(original_files, supported_audio_files,
+                               recursive=args.recursive, persist=False)
 
     if not args.keep:
         [os.remove(f) for f in file_list if os.path.isfile(f)]
     else:
-        [os.remove(f) for f in get_audio_files(
-            os.getcwd(), supported_audio_files) if f not in file_list]
+        [os.remove(f) for f in list_files(
+            os.getcwd(), supported_audio_files, recursive=args.recursive,
+            persist=False) if f not in file_list]
 
 
 if __name__ == '__main__':
@@ -35,6 +37,8 @@ if __name__ == '__main__':
     parser.add_argument('-k', '--keep', action='store_true',
                         help='keep option: Keeps matching audio files'
                         ' and removes the rest')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='Compare audio files in subdirectories too')
     args = parser.parse_args()
 
     try:
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import argparse
+from collections import deque
+
+
+# entries kept in the file for invocations with a longer --list-len, an
+# add rewrites at most this many
+default_retain = 1000
+
+
+class PlayHistory:
+
+    def __init__(self, size, history_file=None, persist=True,
+                 retain=default_retain):
+        if history_file is None:
+            history_file = os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    'play_history.json')
+        self.history_file = history_file
+        self.persist = persist
+        self.size = max(size, 0)
+        self.retain = max(retain, self.size)
+        self._ring = [None] * self.size
+        self._head = 0
+        self._count = 0
+        self._members = {}
+        self._last_played = {}
+        # entries older than this window kept for invocations with a
+        # longer --list-len sharing the file
+        self._older = deque(maxlen=self.retain - self.size)
+        self._mtime = None
+        if self.persist:
+            self.load()
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, track):
+        return track in self._members
+
+    def __iter__(self):
+        for offset in range(self._count, 0, -1):
+            yield self._ring[(self._head - offset) % self.size]
+
+    def __push(self, track, timestamp):
+        if self.size == 0:
+            return None
+        if self._count == self.size:
+            old_track, _ = self._ring[self._head]
+            self._older.append(self._ring[self._head])
+            if self._members[old_track] == 1:
+                del self._members[old_track]
+            else:
+                self._members[old_track] -= 1
+        else:
+            self._count += 1
+        self._ring[self._head] = (track, timestamp)
+        self._head = (self._head + 1) % self.size
+        self._members[track] = self._members.get(track, 0) + 1
+        if timestamp > self._last_played.get(track, 0):
+            self._last_played[track] = timestamp
+
+    def __reset(self, entries, last_played):
+        self._ring = [None] * self.size
+        self._head = 0
+        self._count = 0
+        self._members = {}
+        self._last_played = dict(last_played)
+        entries = entries[-self.retain:]
+        split = max(len(entries) - self.size, 0)
+        self._older = deque(entries[:split], maxlen=self.retain - self.size)
+        for track, timestamp in entries[split:]:
+            self.__push(track, timestamp)
+
+    def recent(self, track, count):
+        for offset in range(1, min(count, self._count) + 1):
+            if self._ring[(self._head - offset) % self.size][0] == track:
+                return True
+        return False
+
+    def last(self):
+        if self._count == 0:
+            return None
+        return self._ring[(self._head - 1) % self.size][0]
+
+    def last_played(self, track):
+        return self._last_played.get(track)
+
+    def __read(self):
+        try:
+            with open(self.history_file, 'r', encoding='utf-8') as fp:
+                data = json.load(fp)
+            return ([tuple(e) for e in data.get('entries', [])],
+                    data.get('last_played', {}))
+        except (OSError, ValueError, TypeError):
+            return [], {}
+
+    def load(self):
+        entries, last_played = self.__read()
+        self.__reset(entries, last_played)
+        try:
+            self._mtime = os.stat(self.history_file).st_mtime_ns
+        except OSError:
+            self._mtime = None
+
+    def add(self, track, timestamp=None):
+        self.__push(track, time.time() if timestamp is None else timestamp)
+        self.save()
+
+    def save(self):
+        if not self.persist:
+            return None
+        entries = list(self._older) + list(self)
+        last_played = self._last_played
+        try:
+            mtime = os.stat(self.history_file).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime is not None and mtime != self._mtime:
+            # another invocation wrote in the meantime, merge by timestamp
+            disk_entries, disk_last_played = self.__read()
+            entries = sorted(set(entries) | set(disk_entries),
+                             key=lambda e: e[1])
+            for track, timestamp in disk_last_played.items():
+                if timestamp > last_played.get(track, 0):
+                    last_played[track] = timestamp
+            self.__reset(entries, last_played)
+            entries = list(self._older) + list(self)
+        temp_file = '{}.{}.tmp'.format(self.history_file, os.getpid())
+        try:
+            with open(temp_file, 'w', encoding='utf-8') as fp:
+                json.dump({'entries': entries,
+                           'last_played': self._last_played}, fp,
+                          separators=(',', ':'))
+            os.replace(temp_file, self.history_file)
+            self._mtime = os.stat(self.history_file).st_mtime_ns
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='play history',
+            description='Show the shared anti-repeat history', epilog='')
+    parser.add_argument('-f', '--file', type=str, default=None,
+                        help='History file')
+    parser.add_argument('-n', '--count', type=int, default=20,
+                        help='Number of entries to show')
+    parser.add_argument('--clear', action='store_true',
+                        help='Remove all entries')
+    args = parser.parse_args()
+
+    try:
+        history = PlayHistory(1 << 20, args.file)
+        if args.clear:
+            os.remove(history.history_file)
+            raise SystemExit(0)
+        for track, timestamp in list(history)[-args.count:]:
+            print('{} - {}'.format(time.strftime(
+                '%D - %H:%M:%S', time.localtime(timestamp)), track))
+    except KeyboardInterrupt:
+        print('Program interrupted')
+        raise SystemExit(0)
+    except Exception as e:
+        print('Exception encountered:', e)
+        raise SystemExit(1)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import queue
+import shlex
+import collections
+import signal
+import argparse
+import selectors
+import threading
+import subprocess
+
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def pidfd_supported():
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+        return True
+    except (AttributeError, OSError):
+        return False
+
+
+class Job:
+
+    def __init__(self, command=None, target=None, args=(), data=None,
+                 stderr=None):
+        # a process running command or a thread running target(*args),
+        # stderr of the process is written to the stderr file if given
+        self.command = command
+        self.target = target
+        self.args = args
+        self.data = data
+        self.stderr = stderr
+        self.process = None
+        self.pid = None
+        self.returncode = None
+        self.result = None
+        self.error = None
+        self.cpu_time = None
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def wall_time(self):
+        if self.start_time is None:
+            return None
+        return (self.end_time or time.monotonic()) - self.start_time
+
+
+class JobScheduler:
+
+    def __init__(self, limit=os.cpu_count()):
+        self.limit = max(1, limit or 1)
+        self.running = {}
+        self.finished = []
+        self.pending = collections.deque()
+        self.peak = 0
+        self.start_time = None
+        self._done = queue.SimpleQueue()
+        self._selector = selectors.DefaultSelector()
+        # finished threads (and SIGCHLD without pidfds) write to this pipe
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        os.set_blocking(self._write_fd, False)
+        self._selector.register(self._read_fd, selectors.EVENT_READ, None)
+        self._pidfd = pidfd_supported()
+        self._signals = None
+        self._timeout = None
+        if not self._pidfd:
+            self.__watch_sigchld()
+
+    def __watch_sigchld(self):
+        try:
+            handler = signal.signal(signal.SIGCHLD, lambda *args: None)
+            self._signals = (handler, signal.set_wakeup_fd(self._write_fd))
+        except ValueError:
+            # signals are only set in the main thread, poll instead
+            self._timeout = 0.1
+
+    def __wake(self):
+        try:
+            os.write(self._write_fd, b'\0')
+        except BlockingIOError:
+            pass
+
+    def __drain(self):
+        try:
+            while os.read(self._read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def __run_thread(self, job):
+        cpu_time = time.thread_time()
+        try:
+            job.result = job.target(*job.args)
+            job.returncode = 0
+        except Exception as e:
+            job.error = e
+            job.returncode = 1
+        job.cpu_time = time.thread_time() - cpu_time
+        job.end_time = time.monotonic()
+        self._done.put(job)
+        self.__wake()
+
+    def start(self, job):
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+        job.start_time = time.monotonic()
+        if job.command is None:
+            self.running[job] = None
+            threading.Thread(target=self.__run_thread, args=(job,),
+                             daemon=True).start()
+        else:
+            stderr = subprocess.DEVNULL
+            if job.stderr is not None:
+                stderr = open(job.stderr, 'wb')
+            try:
+                job.process = subprocess.Popen(
+                        job.command, stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL, stderr=stderr)
+            finally:
+                if job.stderr is not None:
+                    stderr.close()
+            job.pid = job.process.pid
+            self.running[job] = None
+            if self._pidfd:
+                pidfd = os.pidfd_open(job.pid)
+                self._selector.register(pidfd, selectors.EVENT_READ, job)
+                self.running[job] = pidfd
+        self.peak = max(self.peak, len(self.running))
+        return job
+
+    def __reap(self, job, flags=0):
+        # wait4 returns the resource usage of the child and of the
+        # processes it waited for (ffmpeg-normalize runs ffmpeg)
+        try:
+            pid, status, rusage = os.wait4(job.pid, flags)
+        except ChildProcessError:
+            job.returncode = job.process.poll()
+            return True
+        if pid == 0:
+            return False
+        job.returncode = exit_code(status)
+        job.process.returncode = job.returncode
+        job.cpu_time = rusage.ru_utime + rusage.ru_stime
+        job.end_time = time.monotonic()
+        return True
+
+    def __finish(self, job):
+        pidfd = self.running.pop(job)
+        if pidfd is not None:
+            self._selector.unregister(pidfd)
+            os.close(pidfd)
+        self.finished.append(job)
+
+    def wait(self):
+        # blocks until at least one running job has finished
+        finished = []
+        while self.running and not finished:
+            for key, _ in self._selector.select(self._timeout):
+                if key.data is None:
+                    self.__drain()
+                elif self.__reap(key.data):
+                    finished.append(key.data)
+            while True:
+                try:
+                    finished.append(self._done.get_nowait())
+                except queue.Empty:
+                    break
+            if not self._pidfd:
+                for job in list(self.running):
+                    if job.process is not None and self.__reap(
+                            job, os.WNOHANG):
+                        finished.append(job)
+        for job in finished:
+            self.__finish(job)
+        return finished
+
+    def submit(self, job):
+        # follow-up jobs start before the next job of run()
+        self.pending.append(job)
+
+    def run(self, jobs):
+        # yields jobs as they finish, the next job starts as soon as one
+        # finishes
+        jobs = iter(jobs)
+        while True:
+            while len(self.running) < self.limit:
+                if self.pending:
+                    job = self.pending.popleft()
+                else:
+                    job = next(jobs, None)
+                if job is None:
+                    break
+                self.start(job)
+            if not self.running:
+                return None
+            yield from self.wait()
+
+    def stop(self, terminate=False):
+        # waits for the running jobs, children are not reaped before
+        # wait4 so their pids are still valid
+        if terminate:
+            for job in self.running:
+                if job.process is not None:
+                    os.kill(job.pid, signal.SIGTERM)
+        finished = []
+        while self.running:
+            finished.extend(self.wait())
+        return finished
+
+    def close(self):
+        if self._read_fd is None:
+            return None
+        if self._signals is not None:
+            signal.signal(signal.SIGCHLD, self._signals[0])
+            signal.set_wakeup_fd(self._signals[1])
+        self._selector.close()
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+        self._read_fd = None
+
+    def stats(self):
+        elapsed = 0
+        if self.start_time is not None:
+            elapsed = time.monotonic() - self.start_time
+        wall_time = sum(job.wall_time for job in self.finished)
+        cpu_time = sum(job.cpu_time or 0 for job in self.finished)
+        return 'Jobs: {} finished, {} failed, peak {} running, wall {:.2f} ' \
+            's, cpu {:.2f} s, {:.2f}x parallel in {:.2f} s'.format(
+                len(self.finished),
+                sum(job.returncode != 0 for job in self.finished),
+                self.peak, wall_time, cpu_time,
+                wall_time / elapsed if elapsed > 0 else 0, elapsed)
+
+
+def format_job(job, name):
+    return 'Return code: {:3}, wall {:7.2f} s, cpu {:7.2f} s, {}'.format(
+            job.returncode, job.wall_time, job.cpu_time or 0, name)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='job_scheduler',
+            description='Run a command once per file with a limited number '
+            'of parallel jobs, {} in the command is replaced with the file',
+            epilog='')
+    parser.add_argument('command', type=str,
+                        help='Command, e.g. "ffmpeg -i {} -f null -"')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('-l', '--limit', type=int, default=os.cpu_count(),
+                        help='Parallel jobs \"default = cpu count\"')
+    args = parser.parse_args()
+
+    scheduler = JobScheduler(args.limit)
+    try:
+        command = shlex.split(args.command)
+        jobs = (Job([file if arg == '{}' else arg for arg in command],
+                    data=file) for file in args.files)
+        for job in scheduler.run(jobs):
+            print(format_job(job, job.data))
+        print(scheduler.stats())
+    except KeyboardInterrupt:
+        scheduler.stop()
+        print('Program interrupted')
+        raise SystemExit(0)
+    except Exception as e:
+        print('Exception encountered:', e)
+        raise SystemExit(1)
+    finally:
+        scheduler.close()
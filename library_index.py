@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import hashlib
+import argparse
+
+
+class LibraryIndex:
+
+    def __init__(self, root, extensions, index_file=None, persist=True,
+                 exclude=None):
+        self.root = os.path.abspath(root)
+        self.extensions = tuple(extensions)
+        self.exclude = set(exclude or [])
+        self.persist = persist
+        self.dirs_scanned = 0
+        self.dirs_reused = 0
+        self._dirs = {}
+        self._files = None
+        if index_file is None:
+            index_file = os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    'library_index.{}.json'.format(hashlib.sha1(
+                        self.root.encode()).hexdigest()[:12]))
+        self.index_file = index_file
+        if self.persist:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if data.get('root') != self.root \
+                or data.get('extensions') != list(self.extensions):
+            return None
+        self._dirs = data.get('dirs', {})
+
+    def save(self):
+        if not self.persist:
+            return None
+        temp_file = self.index_file + '.tmp'
+        try:
+            with open(temp_file, 'w', encoding='utf-8') as fp:
+                json.dump({'root': self.root,
+                           'extensions': list(self.extensions),
+                           'dirs': self._dirs}, fp, separators=(',', ':'))
+            os.replace(temp_file, self.index_file)
+        except OSError:
+            pass
+
+    def __scan_dir(self, directory, mtime):
+        files = {}
+        subdirs = []
+        with os.scandir(os.path.join(self.root, directory)) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not (directory == '' and entry.name in self.exclude):
+                        subdirs.append(entry.name)
+                elif entry.name.endswith(self.extensions) \
+                        and entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = [stat.st_size, stat.st_mtime_ns]
+        self.dirs_scanned += 1
+        return {'mtime': mtime, 'files': files, 'subdirs': sorted(subdirs)}
+
+    def refresh(self):
+        dirs = {}
+        scanned = self.dirs_scanned
+        stack = ['']
+        while stack:
+            directory = stack.pop()
+            try:
+                mtime = os.stat(os.path.join(self.root, directory)).st_mtime_ns
+            except OSError:
+                continue
+            cached = self._dirs.get(directory)
+            # a directory mtime only changes when its own entries change
+            if cached is not None and cached['mtime'] == mtime:
+                self.dirs_reused += 1
+            else:
+                try:
+                    cached = self.__scan_dir(directory, mtime)
+                except OSError:
+                    continue
+            dirs[directory] = cached
+            stack.extend(os.path.join(directory, d) for d in cached['subdirs'])
+        changed = self.dirs_scanned != scanned \
+            or dirs.keys() != self._dirs.keys()
+        self._dirs = dirs
+        if changed:
+            self._files = None
+            self.save()
+        return changed
+
+    def files(self):
+        if self._files is None:
+            self._files = sorted(
+                    os.path.join(directory, name)
+                    for directory, entry in self._dirs.items()
+                    for name in entry['files'])
+        return list(self._files)
+
+    def stat(self, relative_path):
+        directory, name = os.path.split(relative_path)
+        entry = self._dirs.get(directory)
+        if entry is None or name not in entry['files']:
+            return None
+        return entry['files'][name]
+
+
+def list_files(root, extensions, recursive=False, persist=True,
+               exclude=None):
+    if not recursive:
+        return sorted(f for f in os.listdir(root)
+                      if f.endswith(tuple(extensions)))
+    index = LibraryIndex(root, extensions, persist=persist, exclude=exclude)
+    index.refresh()
+    return index.files()
+
+
+def create_synthetic_tree(root, file_count, files_per_dir=100):
+    for index in range(file_count):
+        directory = os.path.join(
+                root, 'artist{:04d}'.format(index // (files_per_dir * 10)),
+                'album{:04d}'.format(index // files_per_dir))
+        if index % files_per_dir == 0:
+            os.makedirs(directory, exist_ok=True)
+        open(os.path.join(directory, 'track{:06d}.mp3'.format(index)),
+             'w').close()
+
+
+def benchmark(root, file_count, extensions):
+    from musicplayer import get_audio_files
+    if not os.path.isdir(root):
+        create_synthetic_tree(root, file_count)
+    index_file = root.rstrip(os.sep) + '.index.json'
+    if os.path.exists(index_file):
+        os.remove(index_file)
+
+    start = time.perf_counter()
+    index = LibraryIndex(root, extensions, index_file=index_file)
+    index.refresh()
+    cold = time.perf_counter() - start
+    count = len(index.files())
+
+    start = time.perf_counter()
+    index = LibraryIndex(root, extensions, index_file=index_file)
+    index.refresh()
+    index.files()
+    warm = time.perf_counter() - start
+
+    start = time.perf_counter()
+    flat = sum(len(get_audio_files(directory, extensions))
+               for directory, _, _ in os.walk(root))
+    listdir = time.perf_counter() - start
+
+    print('{} files indexed, {} found by get_audio_files'.format(count, flat))
+    print('cold scan:       {:.3f} s'.format(cold))
+    print('warm refresh:    {:.3f} s ({} directories reused)'
+          .format(warm, index.dirs_reused))
+    print('get_audio_files: {:.3f} s (os.walk + listdir per directory)'
+          .format(listdir))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='library index',
+            description='Recursive audio library index', epilog='')
+    parser.add_argument('path', help='Audio files directory')
+    parser.add_argument('--benchmark', type=int, default=None,
+                        metavar='FILES',
+                        help='Create a synthetic tree with FILES files in '
+                        'PATH (if missing) and time cold scan, warm refresh '
+                        'and get_audio_files')
+    args = parser.parse_args()
+
+    supported_audio_files = ['.mp3', '.wma', '.m4a',
+                             '.webm', '.mkv', '.wav', '.mp4']
+
+    try:
+        if args.benchmark is not None:
+            benchmark(os.path.abspath(args.path), args.benchmark,
+                      supported_audio_files)
+        else:
+            library = LibraryIndex(args.path, supported_audio_files)
+            library.refresh()
+            [print(f) for f in library.files()]
+    except KeyboardInterrupt:
+        print('Program interrupted')
+        raise SystemExit(0)
+    except Exception as e:
+        print('Exception encountered:', e)
+        raise SystemExit(1)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import ctypes
+import ctypes.util
+import struct
+import selectors
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+watch_mask = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+event_header = struct.Struct('iIII')
+
+
+def inotify_init(path):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(path), watch_mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class LibraryWatcher:
+
+    def __init__(self, path, audio_extensions, txt_extensions,
+                 poll_interval: float = 1.0, listing=None):
+        self.path = path
+        self.audio_extensions = tuple(audio_extensions)
+        self.txt_extensions = tuple(txt_extensions)
+        self.poll_interval = poll_interval
+        self.version = 0
+        self.rescans = 0
+        self._audio = set()
+        self._txt = set()
+        self._sorted_audio = None
+        self._sorted_txt = None
+        self._added = []
+        self._mtime = None
+        self._fd = inotify_init(path)
+        if not self.__restore(listing):
+            self.rescan()
+        self._added = []
+
+    def fileno(self):
+        return self._fd
+
+    def __changed(self):
+        self.version += 1
+        self._sorted_audio = None
+        self._sorted_txt = None
+
+    def __add(self, name):
+        if name.endswith(self.audio_extensions) and name not in self._audio:
+            self._audio.add(name)
+            self._added.append(name)
+            self.__changed()
+        elif name.endswith(self.txt_extensions):
+            self._txt.add(name)
+            self.__changed()
+
+    def __remove(self, name):
+        if name in self._audio:
+            self._audio.discard(name)
+            self.__changed()
+        elif name in self._txt:
+            self._txt.discard(name)
+            self.__changed()
+
+    def rescan(self):
+        try:
+            self._mtime = os.stat(self.path).st_mtime_ns
+            names = os.listdir(self.path)
+        except OSError:
+            names = []
+        audio = {f for f in names if f.endswith(self.audio_extensions)}
+        txt = {f for f in names if f.endswith(self.txt_extensions)}
+        self._added.extend(sorted(audio - self._audio))
+        if audio != self._audio or txt != self._txt:
+            self._audio, self._txt = audio, txt
+            self.__changed()
+        self.rescans += 1
+
+    def __restore(self, listing):
+        # (mtime_ns, audio, txt) from listing(), valid while the directory
+        # mtime is unchanged
+        if listing is None:
+            return False
+        mtime, audio, txt = listing
+        try:
+            if os.stat(self.path).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+        self._mtime = mtime
+        self._audio, self._txt = set(audio), set(txt)
+        self.__changed()
+        return True
+
+    def listing(self):
+        # stat first, a change after it makes the listing stale on restore
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        return mtime, self.audio_files(), self.genre_files()
+
+    def __read_events(self):
+        try:
+            data = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return False
+        except OSError:
+            self.close()
+            return False
+        position = 0
+        rescan = False
+        while position + event_header.size <= len(data):
+            _, mask, _, length = event_header.unpack_from(data, position)
+            position += event_header.size
+            name = os.fsdecode(data[position:position + length].rstrip(b'\0'))
+            position += length
+            if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF | IN_MOVE_SELF):
+                rescan = True
+            elif mask & IN_ISDIR:
+                continue
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.__remove(name)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.__add(name)
+            elif mask & IN_MODIFY and name in self._txt:
+                self.__changed()
+        if rescan:
+            self.rescan()
+        return True
+
+    def update(self):
+        if self._fd is not None:
+            while self.__read_events():
+                pass
+            return None
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            self.rescan()
+
+    def audio_files(self):
+        self.update()
+        if self._sorted_audio is None:
+            self._sorted_audio = sorted(self._audio)
+        return list(self._sorted_audio)
+
+    def genre_files(self):
+        self.update()
+        if self._sorted_txt is None:
+            self._sorted_txt = sorted(self._txt)
+        return list(self._sorted_txt)
+
+    def pop_added(self):
+        self.update()
+        added, self._added = self._added, []
+        return [f for f in added if f in self._audio]
+
+    def wait_for_change(self, timeout=None):
+        version = self.version
+        if self._fd is None:
+            time.sleep(self.poll_interval if timeout is None
+                       else min(timeout, self.poll_interval))
+            self.update()
+            return self.version != version
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._fd, selectors.EVENT_READ)
+            selector.select(timeout)
+        self.update()
+        return self.version != version
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import gzip
+import time
+import fcntl
+import atexit
+import argparse
+import tempfile
+import threading
+
+
+class LogWriter:
+
+    def __init__(self, log_file, minimum_lines=400, maximum_lines=2000,
+                 limit=True, backups=0, compress=False, flush_interval=1.0,
+                 flush_lines=256):
+        self.log_file = log_file
+        self.minimum_lines = minimum_lines
+        self.maximum_lines = maximum_lines
+        self.limit = limit
+        self.backups = backups
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.flush_lines = flush_lines
+        self.lines_written = 0
+        self.flushes = 0
+        self.rotations = 0
+        # lines in the file as far as this writer knows, the file is only
+        # read back when it passes maximum_lines
+        self._line_count = 0
+        self._partial = ''
+        self._pending = []
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._fd = None
+        self._inode = None
+        self._running = True
+        self.__open()
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __open(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.log_file,
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._inode = os.fstat(self._fd).st_ino
+        with open(self.log_file, 'rb') as fp:
+            self._line_count = sum(1 for _ in fp)
+
+    def __reopen_if_moved(self):
+        # the file may have been deleted or replaced, e.g. reset at startup
+        try:
+            inode = os.stat(self.log_file).st_ino
+        except OSError:
+            inode = None
+        if inode != self._inode:
+            self.__open()
+
+    def write(self, *args, **kwargs):
+        buffer = io.StringIO()
+        print(*args, file=buffer, **kwargs)
+        with self._condition:
+            self._pending.append(buffer.getvalue())
+            if len(self._pending) >= self.flush_lines:
+                self._condition.notify()
+
+    def __write_backup(self, lines):
+        if self.backups < 1 or not lines:
+            return None
+        suffix = '.gz' if self.compress else ''
+        for index in range(self.backups - 1, 0, -1):
+            source = '{}.{}{}'.format(self.log_file, index, suffix)
+            if os.path.exists(source):
+                os.replace(source, '{}.{}{}'.format(
+                    self.log_file, index + 1, suffix))
+        data = ''.join(line + '\n' for line in lines).encode('utf-8')
+        if self.compress:
+            data = gzip.compress(data)
+        backup_file = '{}.1{}'.format(self.log_file, suffix)
+        with open(backup_file + '.tmp', 'wb') as fp:
+            fp.write(data)
+        os.replace(backup_file + '.tmp', backup_file)
+
+    def __rotate(self):
+        # musicplayer and musicplayer_extended may share the log, the lock
+        # keeps the other writer out between reading the tail and
+        # truncating, and the tail includes its lines
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            with open(self.log_file, 'r', encoding='utf-8',
+                      errors='replace') as fp:
+                lines = [line.rstrip('\n') for line in fp]
+            if len(lines) <= self.maximum_lines:
+                # the other writer rotated already
+                self._line_count = len(lines)
+                return None
+            kept = lines[-self.minimum_lines:]
+            self.__write_backup(lines[:-self.minimum_lines])
+            # truncate in place so the hard link from create_link() stays
+            # valid
+            os.ftruncate(self._fd, 0)
+            os.write(self._fd, ''.join(
+                line + '\n' for line in kept).encode('utf-8'))
+            self._line_count = len(kept)
+            self.rotations += 1
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def flush(self):
+        with self._flush_lock:
+            self.__flush()
+
+    def __flush(self):
+        with self._condition:
+            pending, self._pending = self._pending, []
+        if not pending or self._fd is None:
+            return None
+        self.__reopen_if_moved()
+        text = ''.join(pending)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            os.write(self._fd, text.encode('utf-8'))
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        self._line_count += len(lines)
+        self.lines_written += len(lines)
+        self.flushes += 1
+        if self.limit and self._line_count > self.maximum_lines:
+            self.__rotate()
+
+    def __run(self):
+        while True:
+            with self._condition:
+                if self._running and len(self._pending) < self.flush_lines:
+                    self._condition.wait(self.flush_interval)
+                running = self._running
+            try:
+                self.flush()
+            except OSError:
+                pass
+            if not running:
+                return None
+
+    def close(self):
+        with self._condition:
+            if not self._running:
+                return None
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def benchmark(line_count):
+    from musicplayer import print_to_file, trim_log_file
+    line = 'Skipping "track000000.mp3" in previously played tracks list...'
+    with tempfile.TemporaryDirectory() as directory:
+        log_file = os.path.join(directory, 'legacy.log')
+        open(log_file, 'w').close()
+        start = time.perf_counter()
+        for _ in range(line_count):
+            print_to_file(log_file, line)
+            trim_log_file(log_file, 400, 2000)
+        legacy = time.perf_counter() - start
+
+        log_file = os.path.join(directory, 'buffered.log')
+        start = time.perf_counter()
+        writer = LogWriter(log_file)
+        for _ in range(line_count):
+            writer.write(line)
+        writer.close()
+        buffered = time.perf_counter() - start
+    print('{} lines'.format(line_count))
+    print('print_to_file + trim_log_file: {:>10.0f} lines/s'.format(
+        line_count / legacy))
+    print('LogWriter (incl. final flush): {:>10.0f} lines/s'.format(
+        line_count / buffered))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='log writer',
+            description='Compare the buffered log writer with '
+            'print_to_file + trim_log_file', epilog='')
+    parser.add_argument('-n', '--lines', type=int, default=20000,
+                        help='Number of lines to write')
+    args = parser.parse_args()
+
+    try:
+        benchmark(args.lines)
+    except KeyboardInterrupt:
+        print('Program interrupted')
+        raise SystemExit(0)
+    except Exception as e:
+        print('Exception encountered:', e)
+        raise SystemExit(1)
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import threading
+from job_scheduler import Job, JobScheduler
+from convert_manifest import file_hash
+
+
+loudness_fields = ['integrated', 'lra', 'true_peak', 'rms', 'peak',
+                   'duration']
+# last value of each field in the ffmpeg log, ebur128 prints its summary
+# and volumedetect its totals when the input ends
+loudness_patterns = {
+    'integrated': re.compile(r'\bI:\s+(-?[\d.]+|-inf) LUFS'),
+    'lra': re.compile(r'\bLRA:\s+(-?[\d.]+) LU\b'),
+    'true_peak': re.compile(r'\bPeak:\s+(-?[\d.]+|-inf) dBFS'),
+    'rms': re.compile(r'\bmean_volume:\s+(-?[\d.]+|-inf) dB'),
+    'peak': re.compile(r'\bmax_volume:\s+(-?[\d.]+|-inf) dB'),
+}
+time_pattern = re.compile(r'\btime=(\d+):(\d+):(\d+(?:\.\d+)?)')
+# ffmpeg-normalize defaults
+default_target = -23.0
+default_true_peak = -2.0
+
+
+def measure_command(input_file):
+    # one decode measures EBU R128 loudness, true peak, RMS and peak
+    return [
+        'ffmpeg',
+        '-nostdin',
+        '-hide_banner',
+        '-i',
+        input_file,
+        '-vn',
+        '-af',
+        'ebur128=peak=true:framelog=verbose,volumedetect',
+        '-f',
+        'null',
+        '-'
+    ]
+
+
+def parse_level(value):
+    # silence measures -inf, it gets no gain
+    return None if value == '-inf' else float(value)
+
+
+def parse_measurement(text):
+    measurement = dict.fromkeys(loudness_fields)
+    for field, pattern in loudness_patterns.items():
+        matches = pattern.findall(text)
+        if matches:
+            measurement[field] = parse_level(matches[-1])
+    times = time_pattern.findall(text)
+    if times:
+        hours, minutes, seconds = times[-1]
+        measurement['duration'] = int(hours) * 3600 + int(minutes) * 60 \
+            + float(seconds)
+    if not loudness_patterns['integrated'].search(text) \
+            or measurement['duration'] is None:
+        raise ValueError('No loudness summary in the ffmpeg output')
+    return measurement
+
+
+def read_measurement(log_file):
+    with open(log_file, 'r', encoding='utf-8', errors='replace') as fp:
+        return parse_measurement(fp.read())
+
+
+def linear_gain(measurement, mode, target=default_target,
+                true_peak=default_true_peak):
+    # gain in dB that moves the level to target, limited so that ebu stays
+    # under the true peak target and rms/peak do not clip
+    if mode == 'ebu':
+        level, ceiling = measurement['integrated'], true_peak
+        peak = measurement['true_peak']
+    else:
+        level = measurement['rms' if mode == 'rms' else 'peak']
+        ceiling, peak = 0.0, measurement['peak']
+    if level is None:
+        return 0.0
+    gain = target - level
+    if peak is not None:
+        gain = min(gain, ceiling - peak)
+    return gain
+
+
+def filter_graph(measurement, mode=None, target=default_target,
+                 fade_in=0, fade_out=0):
+    # gain and fades in one graph, the encode is the only other decode
+    filters = []
+    if mode is not None:
+        filters.append('volume={:.2f}dB'.format(
+            linear_gain(measurement, mode, target)))
+    if fade_in > 0:
+        filters.append('afade=t=in:st=0:d={}'.format(fade_in))
+    if fade_out > 0 and measurement['duration'] is not None:
+        filters.append('afade=t=out:st={:.3f}:d={}'.format(
+            max(measurement['duration'] - fade_out, 0), fade_out))
+    return ','.join(filters) or 'anull'
+
+
+def encode_command(input_file, output_file, graph, bitrate='128k'):
+    return [
+        'ffmpeg',
+        '-nostdin',
+        '-i',
+        input_file,
+        '-af',
+        graph,
+        '-c:a',
+        'libmp3lame',
+        '-b:a',
+        bitrate,
+        output_file,
+        '-n'
+    ]
+
+
+class LoudnessCache:
+
+    def __init__(self, cache_file=None):
+        # measurements per source content hash, a new target, bitrate or
+        # fade only needs the encode
+        if cache_file is None:
+            cache_file = os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    'loudness.db')
+        self.cache_file = cache_file
+        self.hits = 0
+        self.measured = 0
+        self._hashes = {}
+        # measured in this run, not counted as reused
+        self._measurements = {}
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is not None:
+            return self._db
+        try:
+            self._db = sqlite3.connect(
+                    self.cache_file, timeout=5, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.Error:
+            self._db = sqlite3.connect(':memory:', check_same_thread=False)
+        self._db.execute(
+                'CREATE TABLE IF NOT EXISTS loudness ('
+                'hash TEXT PRIMARY KEY, integrated REAL, lra REAL, '
+                'true_peak REAL, rms REAL, peak REAL, duration REAL, '
+                'measured REAL)')
+        return self._db
+
+    def key(self, audio_file, source_hash=None):
+        # the hash of a file is computed once per size and mtime
+        stat = os.stat(audio_file)
+        path = os.path.abspath(audio_file)
+        entry = self._hashes.get(path)
+        if source_hash is None:
+            if entry is not None and entry[:2] == (stat.st_size,
+                                                   stat.st_mtime_ns):
+                return entry[2]
+            source_hash = file_hash(audio_file)
+        self._hashes[path] = (stat.st_size, stat.st_mtime_ns, source_hash)
+        return source_hash
+
+    def lookup(self, key):
+        if key in self._measurements:
+            return self._measurements[key]
+        with self._lock:
+            row = self._connect().execute(
+                    'SELECT {} FROM loudness WHERE hash = ?'.format(
+                        ', '.join(loudness_fields)), (key,)).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        return dict(zip(loudness_fields, row))
+
+    def store(self, key, measurement):
+        self._measurements[key] = measurement
+        with self._lock:
+            db = self._connect()
+            try:
+                db.execute('INSERT OR REPLACE INTO loudness VALUES '
+                           '(?, ?, ?, ?, ?, ?, ?, ?)', (key,) + tuple(
+                               measurement[field]
+                               for field in loudness_fields) + (time.time(),))
+                db.commit()
+            except sqlite3.Error:
+                db.rollback()
+            self.measured += 1
+
+    def count(self):
+        with self._lock:
+            return self._connect().execute(
+                    'SELECT COUNT(*) FROM loudness').fetchone()[0]
+
+    def stats(self):
+        return 'Loudness cache: {} measured, {} reused'.format(
+                self.measured, self.hits)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def run_jobs(jobs, follow_up, limit):
+    # runs jobs and the jobs follow_up returns for each finished job
+    scheduler = JobScheduler(limit)
+    try:
+        for job in scheduler.run(jobs):
+            if job.returncode != 0:
+                raise RuntimeError('{} exited with {}'.format(
+                    job.command[0], job.returncode))
+            for next_job in follow_up(job):
+                scheduler.submit(next_job)
+    finally:
+        scheduler.stop(terminate=True)
+        scheduler.close()
+
+
+def benchmark(audio_files, mode, fade_in, fade_out, bitrate, limit):
+    # normalized + fade with ffmpeg-normalize and a second convert2mp3 run,
+    # against measure + one encode and an encode with cached measurements
+    from probe_cache import ProbeCache
+    directory = tempfile.mkdtemp(prefix='loudness_benchmark.')
+    probe_cache = ProbeCache(os.path.join(directory, 'probe_cache.db'))
+    names = [os.path.join(directory, '{:05d}'.format(index))
+             for index in range(len(audio_files))]
+    try:
+        def legacy_fade(job):
+            normalized, output = job.data
+            if output is None:
+                return []
+            duration = probe_cache.get_duration(normalized)
+            return [Job([
+                'ffmpeg', '-nostdin', '-i', normalized, '-af',
+                'afade=in:st=0:d={},afade=out:st={}:d={}'.format(
+                    fade_in, duration - fade_out, fade_out), output, '-n'],
+                data=(output, None))]
+
+        start = time.monotonic()
+        run_jobs((Job([
+            'ffmpeg-normalize', f, '-nt', mode, '-c:a', 'libmp3lame', '-b:a',
+            bitrate, '-ext', 'mp3', '-o', name + '.normalized.mp3'],
+            data=(name + '.normalized.mp3', name + '.legacy.mp3'))
+            for f, name in zip(audio_files, names)), legacy_fade, limit)
+        legacy = time.monotonic() - start
+
+        cache = LoudnessCache(os.path.join(directory, 'loudness.db'))
+
+        def pipeline_encode(job):
+            input_file, name, log_file = job.data
+            if log_file is None:
+                return []
+            cache.store(cache.key(input_file), read_measurement(log_file))
+            return [pipeline_job(input_file, name)]
+
+        def pipeline_job(input_file, name):
+            measurement = cache.lookup(cache.key(input_file))
+            if measurement is None:
+                return Job(measure_command(input_file),
+                           data=(input_file, name, name + '.log'),
+                           stderr=name + '.log')
+            return Job(encode_command(
+                input_file, name + '.pipeline.mp3', filter_graph(
+                    measurement, mode, default_target, fade_in, fade_out),
+                bitrate), data=(input_file, name, None))
+
+        timings = []
+        for run in range(2):
+            [os.remove(name + '.pipeline.mp3') for name in names
+             if os.path.exists(name + '.pipeline.mp3')]
+            start = time.monotonic()
+            run_jobs((pipeline_job(f, name)
+                      for f, name in zip(audio_files, names)),
+                     pipeline_encode, limit)
+            timings.append(time.monotonic() - start)
+        cache.close()
+    finally:
+        probe_cache.close()
+        shutil.rmtree(directory)
+    print('{} files, {} mode, fade {}/{} s, {}'.format(
+        len(audio_files), mode, fade_in, fade_out, bitrate))
+    print('ffmpeg-normalize + fade: {:8.2f} s, 3 decode passes per file'
+          .format(legacy))
+    print('pipeline:                {:8.2f} s, 2 decode passes per file, '
+          '{:.2f}x'.format(timings[0], legacy / timings[0]))
+    print('pipeline, measured:      {:8.2f} s, 1 decode pass per file, '
+          '{:.2f}x'.format(timings[1], legacy / timings[1]))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='loudness',
+            description='Measure loudness (integrated, LRA, true peak, '
+            'RMS, peak) into loudness.db and show the linear gain used by '
+            'convert2mp3',
+            epilog='')
+    parser.add_argument('files', nargs='+', help='Audio files')
+    parser.add_argument('-m', '--mode', choices=['ebu', 'rms', 'peak'],
+                        default='ebu', help='Normalized modes, default=ebu')
+    parser.add_argument('-t', '--target', type=float, default=default_target,
+                        help='Target level in LUFS (ebu) or dBFS \"default '
+                        '= -23\"')
+    parser.add_argument('-b', '--bitrate', type=str, default='128k')
+    parser.add_argument('--fade-in', type=float, default=2.00)
+    parser.add_argument('--fade-out', type=float, default=2.00)
+    parser.add_argument('-l', '--limit', type=int, default=os.cpu_count(),
+                        help='Parallel jobs \"default = cpu count\"')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Compare ffmpeg-normalize + fade with the '
+                        'single-pass pipeline on the files')
+    args = parser.parse_args()
+
+    try:
+        if args.benchmark:
+            benchmark(args.files, args.mode, args.fade_in, args.fade_out,
+                      args.bitrate, args.limit)
+            raise SystemExit(0)
+        fd, log_file = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+        cache = LoudnessCache()
+        scheduler = JobScheduler(1)
+        try:
+            for file in args.files:
+                key = cache.key(file)
+                measurement = cache.lookup(key)
+                if measurement is None:
+                    job = next(scheduler.run([Job(measure_command(file),
+                                                  stderr=log_file)]))
+                    if job.returncode != 0:
+                        print('Exit code {}: {}'.format(job.returncode,
+                                                        file))
+                        continue
+                    measurement = read_measurement(log_file)
+                    cache.store(key, measurement)
+                print(' '.join('{}={}'.format(key, measurement[key])
+                               for key in loudness_fields),
+                      'gain={:.2f}'.format(linear_gain(
+                          measurement, args.mode, args.target)), file)
+            print(cache.stats(), '({} in {})'.format(cache.count(),
+                                                     cache.cache_file))
+        finally:
+            scheduler.close()
+            cache.close()
+            os.remove(log_file)
+    except KeyboardInterrupt:
+        print('Program interrupted')
+        raise SystemExit(0)
+    except Exception as e:
+        print('Exception encountered:', e)
+        raise SystemExit(1)
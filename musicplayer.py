@@ -1,22 +1,38 @@
 #!/usr/bin/env python3
 
 import os
-import random
 import time
+import atexit
 import argparse
 import pathlib
 import textwrap
-import datetime
+import selectors
+import signal
+from probe_cache import ProbeCache
+from progress_reader import ProgressReader
+from read_ahead import ReadAhead
+from library_watcher import LibraryWatcher
+from library_index import LibraryIndex
+from playlist import PlaylistCompiler
+from playlist import TrackStream
+from playlist import read_weighted_list
+from history import PlayHistory
+from log_writer import LogWriter
+from telemetry import Telemetry
+from telemetry import LatencyStats
+from scheduler import SleepSchedule
+from scheduler import WeeklySchedule
+from control import ControlServer
+from snapshot import Snapshot
+from snapshot import StartupProfile
 
 
 def my_print(*args, **kwargs):
     if verbose > 1:
         args = (time.strftime('%D - %H:%M:%S :'),) + args
     print(*args, **kwargs)
-    if enable_log:
-        print_to_file(log_file, *args, **kwargs)
-        if not disable_log_limit:
-            trim_log_file(log_file, 400, 2000)
+    if log_writer is not None:
+        log_writer.write(*args, **kwargs)
 
 
 def print_to_file(log_file, *args, **kwargs):
@@ -59,6 +75,32 @@ def get_audio_files(filepath, input_list):
     return audio_files
 
 
+def list_library(library_watcher, index):
+    if index is None:
+        return library_watcher.audio_files()
+    index.refresh()
+    return index.files()
+
+
+def get_library_files():
+    return list_library(watcher, library_index)
+
+
+def open_library(filepath, recursive_scan):
+    # watchers and indexes stay open across schedule slots
+    key = (filepath, recursive_scan)
+    if key not in libraries:
+        sort_file_lists(filepath)
+        libraries[key] = (
+                LibraryWatcher(filepath, supported_audio_files,
+                               supported_txt_files, listing=None
+                               if warm_start is None
+                               else warm_start.listing(filepath)),
+                LibraryIndex(filepath, supported_audio_files)
+                if recursive_scan else None)
+    return libraries[key]
+
+
 def get_file_list(file, file_extensions):
     audio_files = []
     if os.path.isfile(file):
@@ -79,47 +121,54 @@ def sort_file_lists(filepath):
     genre_files.append('favorites.txt')
     if genre_files:
         for file in genre_files:
-            write_list_to_file(
-                    os.path.join(filepath, str(file)),
-                    get_file_list(os.path.join(
-                        filepath, str(file)), supported_audio_files))
+            if file == 'favorites.txt':
+                file_list = [t if w == 1 else '{}\t{:g}'.format(t, w)
+                             for t, w in read_weighted_list(os.path.join(
+                                 filepath, file), supported_audio_files)]
+            else:
+                file_list = get_file_list(os.path.join(
+                    filepath, str(file)), supported_audio_files)
+            write_list_to_file(os.path.join(filepath, str(file)), file_list)
         if sort_files == 'exit':
             raise SystemExit(0)
 
 
-def format_str_time(input_string):
-    if input_string is None:
-        return None
-    hours, minutes = map(int, input_string.split(':'))
-    output_time = datetime.time(hour=hours, minute=minutes)
-    return output_time
+def sleep_func(schedule):
+    return schedule.sleep_until_active()
 
 
-def sleep_func(timer_start, timer_stop):
-    if timer_start is None:
-        return None
-    while get_sleep_condition(timer_start, timer_stop):
-        time.sleep(3)
+def get_sleep_status(schedule):
+    return schedule.is_sleeping()
 
 
-def get_sleep_status(timer_start, timer_stop):
-    if timer_start is None:
-        return False
-    return get_sleep_condition(timer_start, timer_stop)
+def get_wait_timeout(fade_point, schedule):
+    timeouts = []
+    if fade_point is not None:
+        timeouts.append(max(0, fade_point - time.monotonic()))
+    if schedule and force_kill_subprocess:
+        timeouts.append(schedule.seconds_until_boundary() + 0.01)
+    if not timeouts:
+        return None
+    return min(timeouts)
 
 
-def get_sleep_condition(timer_start, timer_stop):
-    current_time = format_str_time(time.strftime('%H:%M'))
-    if timer_start < timer_stop:
-        return not (timer_start <= current_time < timer_stop)
-    return timer_stop <= current_time < timer_start
+def get_idle_timeout():
+    timeouts = []
+    if library_index is not None:
+        timeouts.append(60)
+    if weekly_schedule:
+        timeouts.append(weekly_schedule.seconds_until_boundary())
+    if not timeouts:
+        return None
+    return min(timeouts)
 
 
 class Musicplayer:
 
     import subprocess
 
-    def __init__(self, audio_gain: float = 1.0, supported_files: list = None):
+    def __init__(self, audio_gain: float = 1.0, supported_files: list = None,
+                 probe_cache: ProbeCache = None):
         self.audio_gain = audio_gain
         self.args_list = [None]
         self.kwargs = {'stdout': open(os.devnull, 'w'),
@@ -127,7 +176,32 @@ class Musicplayer:
         self.audio_file = 'audio_file'
         self.duration = 0
         self.__audio_file_index = 0
+        self.__filter_index = 0
+        self.fade = 0
         self._p = None
+        self._pidfd = None
+        self._previous = None
+        self._spawn_time = None
+        self._exit_time = None
+        self._previous_exit_time = None
+        self.transition_ms = None
+        self._progress = None
+        self.__progress_kind = None
+        self._media_time = None
+        self._selector = selectors.DefaultSelector()
+        self.wakeups = 0
+        self.wait_time = 0
+        self.probe_cache = probe_cache
+        self.probe_ms = None
+        self.spawn_ms = None
+        self.handoff_ms = None
+        self._popen_time = None
+        self._handoff_time = None
+        self._paused_at = None
+        self.paused_time = 0.0
+
+        if self.probe_cache is None:
+            self.probe_cache = ProbeCache()
 
         if supported_files is None:
             self._supported_files = ['.mp3', '.wma', '.m4a',
@@ -136,10 +210,38 @@ class Musicplayer:
             self._supported_files = supported_files
 
     def set_media(self, audio_file):
+        self._media_time = time.monotonic()
         self.args_list[self.__audio_file_index] = audio_file
         self.audio_file = audio_file
         if any(audio_file.endswith(ext) for ext in self._supported_files):
+            probe_start = time.monotonic()
             self.__set_duration(audio_file)
+            self.probe_ms = (time.monotonic() - probe_start) * 1000
+        if self.__filter_index > 0:
+            self.args_list[self.__filter_index] = self.__get_audio_filter()
+
+    def set_fade(self, fade):
+        self.fade = fade
+
+    def set_gain(self, gain):
+        self.audio_gain = gain
+        for index, arg in enumerate(self.args_list):
+            if str(arg).startswith('--gain='):
+                self.args_list[index] = '--gain=' + str(gain)
+
+    def preload(self, audio_file):
+        try:
+            self.probe_cache.get(audio_file)
+        except (OSError, ValueError, TypeError):
+            pass
+
+    def __get_audio_filter(self):
+        audio_filter = 'volume=' + str(self.audio_gain)
+        fade = min(self.fade, self.duration / 2)
+        if fade <= 0:
+            return audio_filter
+        return '{0},afade=t=in:st=0:d={1},afade=t=out:st={2}:d={1}'.format(
+                audio_filter, fade, self.duration - fade)
 
     def set_vlc(self, **kwargs):
         self.loop = '--no-loop'
@@ -175,6 +277,8 @@ class Musicplayer:
                 self.audio_file
             ]
             self.__audio_file_index = self.args_list.index(self.audio_file)
+            self.__filter_index = 0
+            self.__progress_kind = None
             self.kwargs = {}
             return None
         self.args_list = [
@@ -191,6 +295,8 @@ class Musicplayer:
             self.audio_file
         ]
         self.__audio_file_index = self.args_list.index(self.audio_file)
+        self.__filter_index = 0
+        self.__progress_kind = None
         if not self.no_controls:
             self.args_list.extend([
                 '--global-key-play-pause',
@@ -225,6 +331,8 @@ class Musicplayer:
             'volume=' + str(self.audio_gain)
         ]
         self.__audio_file_index = self.args_list.index(self.audio_file)
+        self.__filter_index = self.args_list.index('-af') + 1
+        self.__progress_kind = 'ffplay'
         if not self.enable_video:
             self.args_list.extend(['-nodisp'])
         if self.loop:
@@ -234,156 +342,560 @@ class Musicplayer:
             ])
 
     def __set_duration(self, audio_file):
-        result = self.subprocess.run([
-            'ffprobe',
-            '-v',
-            'error',
-            '-show_entries',
-            'format=duration',
-            '-of',
-            'default=noprint_wrappers=1:nokey=1',
-            audio_file
-        ], capture_output=True, text=True)
-        self.duration = float(result.stdout)
+        self.duration = self.probe_cache.get_duration(audio_file)
 
     def play(self):
-        self._p = self.subprocess.Popen(self.args_list, **self.kwargs)
+        # a stopped process must not linger as the crossfade partner
+        self.resume()
+        self.__retire_current()
+        popen_start = time.monotonic()
+        if self.__progress_kind is not None:
+            self.__start_with_progress()
+        else:
+            self._p = self.subprocess.Popen(self.args_list, **self.kwargs)
+        self._spawn_time = time.monotonic()
+        self.spawn_ms = (self._spawn_time - popen_start) * 1000
+        self._popen_time = popen_start
+        self.handoff_ms = None
+        if self._handoff_time is not None:
+            # previous exit, or the fade point during a crossfade
+            self.handoff_ms = (self._spawn_time - self._handoff_time) * 1000
+            self._handoff_time = None
+        self._exit_time = None
+        self.transition_ms = None
+        self.paused_time = 0.0
+        self._pidfd = self.__open_pidfd(self._p, 'current')
+        self.__update_transition()
+
+    def __start_with_progress(self):
+        kwargs = dict(self.kwargs)
+        kwargs['stderr'] = self.subprocess.PIPE
+        self._p = self.subprocess.Popen(self.args_list, **kwargs)
+        self._progress = ProgressReader(self._p.stderr, self.__progress_kind)
+        self._selector.register(
+                self._progress, selectors.EVENT_READ, 'progress')
+
+    def __close_progress(self):
+        if self._progress is None:
+            return None
+        self._selector.unregister(self._progress)
+        self._progress.close()
+        self._progress = None
+
+    def has_progress(self):
+        return self._progress is not None
+
+    def pop_events(self):
+        if self._progress is None:
+            return []
+        return self._progress.pop_events()
+
+    def time_to_first_audio(self, first_audio_time=None):
+        if first_audio_time is None:
+            first_audio_time = self._spawn_time
+        return (first_audio_time - self._media_time) * 1000
+
+    def first_audio_ms(self, first_audio_time):
+        return (first_audio_time - self._popen_time) * 1000
+
+    def position(self):
+        if self._progress is None:
+            return None
+        return self._progress.position
+
+    def __open_pidfd(self, process, data):
+        try:
+            pidfd = os.pidfd_open(process.pid)
+            self._selector.register(pidfd, selectors.EVENT_READ, data)
+        except (AttributeError, OSError):
+            return None
+        return pidfd
+
+    def __close_pidfd(self, pidfd):
+        if pidfd is None:
+            return None
+        self._selector.unregister(pidfd)
+        os.close(pidfd)
+
+    def mark_handoff(self):
+        # the fade point, the next play() measures the handoff from here
+        self._handoff_time = time.monotonic()
+
+    def __retire_current(self):
+        # the previous player keeps running during a crossfade
+        self.__close_previous()
+        self.__close_progress()
+        self._previous_exit_time = None
+        if self._p is None:
+            self._handoff_time = None
+            return None
+        if self._p.poll() is None:
+            if self._handoff_time is None:
+                self._handoff_time = time.monotonic()
+            self._previous = (self._p, self._pidfd)
+            if self._pidfd is not None:
+                self._selector.modify(
+                        self._pidfd, selectors.EVENT_READ, 'previous')
+        else:
+            self.__close_pidfd(self._pidfd)
+            self._previous_exit_time = self._exit_time or time.monotonic()
+            if self._handoff_time is None:
+                self._handoff_time = self._previous_exit_time
+        self._pidfd = None
+
+    def __close_previous(self):
+        if self._previous is None:
+            return None
+        process, pidfd = self._previous
+        process.poll()
+        self.__close_pidfd(pidfd)
+        self._previous = None
+        self._previous_exit_time = time.monotonic()
+        self.__update_transition()
+
+    def __update_transition(self):
+        if self._previous_exit_time is None or self._spawn_time is None \
+                or self.transition_ms is not None:
+            return None
+        # positive values are overlap, negative values are silence
+        self.transition_ms = (
+                self._previous_exit_time - self._spawn_time) * 1000
 
     def stop(self):
         if self._p is not None:
             self._p.kill()
 
-    def wait(self):
-        if self._p is not None:
-            self._p.wait()
+    def __processes(self):
+        processes = [self._p]
+        if self._previous is not None:
+            processes.append(self._previous[0])
+        return [process for process in processes
+                if process is not None and process.poll() is None]
+
+    def pause(self):
+        if self._p is None or self._paused_at is not None:
+            return False
+        if not hasattr(self._p, 'send_signal'):
+            raise ValueError('pause is not supported by this backend')
+        for process in self.__processes():
+            process.send_signal(signal.SIGSTOP)
+        self._paused_at = time.monotonic()
+        return True
+
+    def resume(self):
+        if self._paused_at is None:
+            return False
+        for process in self.__processes():
+            process.send_signal(signal.SIGCONT)
+        self.paused_time += time.monotonic() - self._paused_at
+        self._paused_at = None
+        return True
+
+    def is_paused(self):
+        return self._paused_at is not None
+
+    def elapsed(self):
+        if self._spawn_time is None:
+            return None
+        now = self._paused_at or time.monotonic()
+        return now - self._spawn_time - self.paused_time
+
+    def add_reader(self, fileobj):
+        # wake wait() when fileobj is readable, e.g. the control socket
+        self._selector.register(fileobj, selectors.EVENT_READ, 'reader')
+
+    def wait(self, timeout=None):
+        if self._p is None:
+            return None
+        wait_start = time.monotonic()
+        if self._pidfd is not None:
+            for key, _ in self._selector.select(timeout):
+                if key.data == 'previous':
+                    self.__close_previous()
+        else:
+            try:
+                self._p.wait(timeout)
+            except self.subprocess.TimeoutExpired:
+                pass
+        self.wakeups += 1
+        self.wait_time += time.monotonic() - wait_start
+        if self._exit_time is None and self._p.poll() is not None:
+            self._exit_time = time.monotonic()
+        if self._previous is not None and self._previous[0].poll() is not None:
+            self.__close_previous()
+        return self._p.poll()
+
+    def wakeups_per_hour(self):
+        if self.wait_time <= 0:
+            return 0
+        return self.wakeups * 3600 / self.wait_time
 
     def poll(self):
         if self._p is not None:
             return self._p.poll()
 
 
-def load_musicplayer(pq, filepath, current_audio_file, timer_start,
-                     timer_stop):
+def load_musicplayer(pq, filepath, current_audio_file, schedule,
+                     next_audio_file=None):
     current_path = os.path.join(filepath, current_audio_file)
 
     pq.set_media(current_path)
+    startup.mark('probe')
+    emit('probe', track=current_audio_file, probe_ms=pq.probe_ms,
+         source=pq.probe_cache.last_source)
     pq.play()
-
-    time_start = time.time()
+    start = time.monotonic()
+    startup.mark('spawn')
+    emit('start', track=current_audio_file, probe_ms=pq.probe_ms,
+         spawn_ms=pq.spawn_ms, handoff_ms=pq.handoff_ms,
+         duration=pq.duration)
+    latency.add(musicplayer, 'handoff', pq.handoff_ms)
+    latency.add(musicplayer, 'probe', pq.probe_ms)
+    first_audio_ms = None
+    if next_audio_file is not None:
+        pq.preload(os.path.join(filepath, next_audio_file))
+    ttfa_ms = None
+    if not pq.has_progress():
+        ttfa_ms = pq.time_to_first_audio()
+        finish_startup('spawn')
+        if verbose > 0:
+            my_print('Time to first audio: {:.0f} ms (spawn)'.format(ttfa_ms))
+
+    fade_point = None
+    if not disable_fade:
+        fade_point = time.monotonic() + pq.duration - fade
     my_print(current_audio_file)
+    reason = 'exit'
     try:
-        while (((time.time() - time_start) < (pq.duration-fade))
-                or disable_fade) and pq.poll() is None:
-            if get_sleep_status(timer_start, timer_stop) and \
+        while pq.poll() is None:
+            # pausing moves the fade point
+            fade_at = None
+            if fade_point is not None and not pq.is_paused():
+                fade_at = fade_point + pq.paused_time
+            if fade_at is not None and time.monotonic() >= fade_at:
+                pq.mark_handoff()
+                reason = 'fade'
+                break
+            if get_sleep_status(schedule) and \
                     force_kill_subprocess:
                 pq.stop()
-            time.sleep(0.1)  # poll every 100ms
+                pq.wait()
+                reason = 'sleep'
+                break
+            # sleep until the player exits, the fade point, the timer or
+            # a control command
+            pq.wait(get_wait_timeout(fade_at, schedule))
+            for event, value in pq.pop_events():
+                if event == 'first_audio':
+                    ttfa_ms = pq.time_to_first_audio(value)
+                    first_audio_ms = pq.first_audio_ms(value)
+                    finish_startup('first audio')
+                    latency.add(musicplayer, 'first audio', first_audio_ms)
+                    if verbose > 0:
+                        my_print('Time to first audio: {:.0f} ms'
+                                 .format(ttfa_ms))
+            for request in get_control_requests():
+                action = handle_command(request, playing=True)
+                if action == 'skip':
+                    reason = 'skip'
+                elif action == 'stop':
+                    emit('end', track=current_audio_file, reason='stop')
+                    my_print('Playback stopped. Exit with code 0')
+                    raise SystemExit(0)
     except KeyboardInterrupt:
         pq.stop()
+        reason = 'interrupt'
         if not skip_tracks:
+            emit('end', track=current_audio_file, reason=reason)
             raise SystemExit(0)
+    emit('end', track=current_audio_file, reason=reason, exit=pq.poll(),
+         played_s=time.monotonic() - start, probe_ms=pq.probe_ms,
+         spawn_ms=pq.spawn_ms, handoff_ms=pq.handoff_ms, ttfa_ms=ttfa_ms,
+         first_audio_ms=first_audio_ms,
+         gap_ms=None if pq.transition_ms is None else -pq.transition_ms)
+    if verbose > 0 and pq.transition_ms is not None:
+        if pq.transition_ms >= 0:
+            my_print('Crossfade overlap: {:.0f} ms'.format(pq.transition_ms))
+        else:
+            my_print('Gap: {:.0f} ms'.format(-pq.transition_ms))
 
 
-def get_tracklist(filepath, audio_files, genre_files):
+def emit(event, **fields):
+    if telemetry is not None:
+        telemetry.emit(event, **fields)
 
-    track_list = audio_files
 
-    if random_mode:
-        weight_list = get_file_list(
-                os.path.join(filepath, 'favorites.txt'), supported_audio_files)
-        track_list.extend(item for item in weight_list for _ in range(weight))
-        random.shuffle(track_list)
-        if not genre_files:
-            return track_list
-        for file in genre_files:
-            genre_list = get_file_list(
-                    os.path.join(filepath, str(file)), supported_audio_files)
-            track_list = [item for item in track_list
-                          if item not in genre_list]
-            random.shuffle(genre_list)
-            track_list.extend(genre_list)
-    elif genre_files:
-        temp_list = []
-        for file in genre_files:
-            genre_list = get_file_list(
-                    os.path.join(filepath, str(file)), supported_audio_files)
-            track_list = list(set(track_list) - set(genre_list))
-            genre_list = list(set(genre_list))
-            genre_list.sort()
-            temp_list.extend(genre_list)
-        track_list.sort()
-        track_list.extend(temp_list)
+def print_latency_summary():
+    if verbose > 0:
+        [my_print(line) for line in latency.summary(buckets=verbose > 1)]
+
 
-    return track_list
+def log_skip(track, reason):
+    emit('skip', track=track, reason=reason)
+    if verbose > 0:
+        my_print('Skipping "{}" {}...'.format(track, reason))
+
+
+def get_control_requests():
+    if control is None:
+        return []
+    return control.serve()
+
+
+def get_library_track(track):
+    if not track:
+        raise ValueError('enqueue requires a track')
+    target = os.path.normpath(os.path.join(path, str(track)))
+    if not target.startswith(path + os.sep) or not os.path.isfile(target) \
+            or not target.endswith(tuple(supported_audio_files)):
+        raise ValueError('"{}" is not an audio file in "{}"'.format(
+            track, path))
+    return os.path.relpath(target, path)
+
+
+def get_status(playing):
+    position = p.position() if playing else None
+    if position is None and playing:
+        position = p.elapsed()
+    return {
+        'state': ('paused' if p.is_paused() else 'playing')
+        if playing else 'sleeping',
+        'track': track_stream.current if playing else None,
+        'position': None if position is None else round(position, 2),
+        'duration': p.duration if playing else None,
+        'gain': p.audio_gain,
+        'path': path,
+        'next': track_stream.peek(5),
+        'history': [track for track, _ in list(previous_tracks)[-10:]],
+        'slot': str(weekly_schedule.current) if weekly_schedule else None}
+
+
+def handle_command(request, playing=False):
+    command, argument = request.command, request.argument
+    if verbose > 0:
+        my_print('Control: {}'.format(command if argument is None
+                                      else '{} {}'.format(command, argument)))
+    emit('control', command=command)
+    try:
+        if command == 'status':
+            request.reply(**get_status(playing))
+        elif command in ('skip', 'pause') and not playing:
+            raise ValueError('Nothing is playing')
+        elif command == 'skip':
+            p.stop()
+            request.reply(track=track_stream.current)
+        elif command == 'stop':
+            p.stop()
+            request.reply()
+        elif command == 'pause':
+            p.pause()
+            request.reply(paused=p.is_paused())
+        elif command == 'resume':
+            p.resume()
+            request.reply(paused=p.is_paused())
+        elif command == 'enqueue':
+            track = get_library_track(argument)
+            track_stream.enqueue(track)
+            request.reply(track=track)
+        elif command == 'gain':
+            if argument is None:
+                raise ValueError('gain requires a value')
+            p.set_gain(max(min(2, float(argument)), 0))
+            request.reply(gain=p.audio_gain)
+        elif command == 'reload':
+            track_stream.reload()
+            request.reply()
+        else:
+            raise ValueError('Unknown command "{}"'.format(command))
+    except (TypeError, ValueError) as e:
+        request.reply(False, error=str(e))
+        return None
+    return command
 
 
-def main(p):
+def control_sleep(timeout):
+    control.wait(timeout)
+    for request in control.serve():
+        if handle_command(request) == 'stop':
+            my_print('Playback stopped. Exit with code 0')
+            raise SystemExit(0)
 
-    timer_start = format_str_time(start_time)
-    timer_stop = format_str_time(stop_time)
 
-    audio_files = get_audio_files(path, supported_audio_files)
-    genre_files = get_audio_files(path, supported_txt_files)
-    track_list = get_tracklist(path, audio_files, genre_files)
+def parse_slot_options(slot):
+    # options of a schedule line, added to the command line options
+    slot_parser = argparse.ArgumentParser(
+            prog='schedule line {}'.format(slot.line), add_help=False)
+    slot_parser.add_argument('-r', '--random', action='store_true',
+                             default=args.random)
+    slot_parser.add_argument('-R', '--recursive', action='store_true',
+                             default=args.recursive)
+    slot_parser.add_argument('-w', '--weight', type=float,
+                             default=args.weight)
+    slot_parser.add_argument('-g', '--gain', type=float, default=args.gain)
+    slot_parser.add_argument('-f', '--fade', type=float, default=args.fade)
+    slot_parser.add_argument('--wait', action='store_false',
+                             default=args.wait)
+    return slot_parser.parse_args(slot.options)
+
+
+def reload_schedule(schedule):
+    slots = schedule.slots
+    try:
+        if not schedule.reload():
+            return None
+        if not schedule:
+            raise ValueError('no slots')
+        [parse_slot_options(slot) for slot in schedule.slots]
+    except (OSError, ValueError, SystemExit) as e:
+        schedule.slots = slots
+        my_print('Error: schedule file not reloaded ({}). Keeping the '
+                 'previous schedule'.format(e))
+        return None
+    if verbose > 0:
+        my_print('Schedule file reloaded...')
+
+
+def switch_slot(schedule):
+    reload_schedule(schedule)
+    slot = schedule.switch()
+    while slot is None:
+        if terminate:
+            my_print('Playback terminated. Exit with code 0')
+            raise SystemExit(0)
+        if verbose > 0:
+            my_print('------Sleep------')
+        emit('sleep')
+        emit('resume', slept_s=sleep_func(schedule))
+        if verbose > 0:
+            my_print('------Resume------')
+        reload_schedule(schedule)
+        slot = schedule.switch()
+    prebuilt.clear()
+    if verbose > 0:
+        my_print('------Slot: {}------'.format(slot))
+    emit('slot', path=slot.path, line=slot.line)
+    return slot, parse_slot_options(slot)
+
+
+def prebuild_next_slot(schedule):
+    # scan the next slot's library and compile its playlist before the
+    # switch, the first track of the slot then starts from the cache
+    boundary = schedule.next_boundary()
+    if boundary in prebuilt \
+            or schedule.seconds_until_boundary() > prebuild_time:
+        return None
+    prebuilt.add(boundary)
+    slot = schedule.slot_at(boundary)
+    if slot is None or slot is schedule.current:
+        return None
+    start = time.monotonic()
+    options = parse_slot_options(slot)
+    library = open_library(slot.path, options.recursive)
+    audio_files = list_library(*library)
+    if audio_files:
+        playlist_compiler.compile(slot.path, audio_files,
+                                  library[0].genre_files(), options.random,
+                                  abs(options.weight))
+    if verbose > 0:
+        my_print('Prepared "{}" ({} tracks) for {} in {:.0f} ms'.format(
+            slot.path, len(audio_files), boundary.strftime('%H:%M:%S'),
+            (time.monotonic() - start) * 1000))
+
+
+def finish_startup(phase):
+    if startup.finished:
+        return None
+    startup.finish(phase)
+    warm = warm_start is not None and warm_start.restored
+    emit('startup', warm=warm, **startup.fields())
+    if startup_profile:
+        my_print(startup.report() + (' (warm start)' if warm else ''))
+
+
+def save_snapshot():
+    if warm_start is None or track_stream.cycles == 0:
+        return None
+    next_tracks = track_stream.peek(max(read_ahead_tracks, 1))
+    # a finished cycle starts over from a fresh compile
+    stream = track_stream.state() if next_tracks else None
+    warm_start.save(path, get_library_files(), watcher.genre_files(),
+                    watcher.listing(), stream,
+                    p.probe_cache.export(os.path.join(path, t)
+                                         for t in next_tracks))
+
+
+def handle_sigterm(signum, frame):
+    # systemctl stop exits through atexit, so the snapshot is saved
+    p.stop()
+    raise SystemExit(0)
+
+
+def main(p):
+
+    audio_files = get_library_files()
+    genre_files = watcher.genre_files()
+    startup.mark('scan')
+    stream_state = None
+    if warm_start is not None:
+        stream_state = warm_start.pop_stream(path, audio_files, genre_files)
+    if stream_state is not None:
+        track_stream.restore(stream_state)
+    else:
+        track_stream.start(path, audio_files, genre_files, random_mode,
+                           weight)
+    startup.mark('compile')
     m3u_list = []
     create_link()
+    watcher.pop_added()
+
+    for track in track_stream.cycle():
 
-    for track in track_list:
+        # files added to the library mid-cycle join the current cycle
+        for added in watcher.pop_added():
+            if verbose > 0:
+                my_print('Adding "{}" to the tracklist...'.format(added))
+            track_stream.add(added)
 
         target = os.path.join(path, track)
 
-        if get_sleep_status(timer_start, timer_stop):
+        if get_sleep_status(sleep_schedule):
+            if weekly_schedule:
+                # the next slot is started by the outer loop
+                return None
             if terminate:
                 my_print('Playback terminated. Exit with code 0')
                 raise SystemExit(0)
             if verbose > 0:
                 my_print('------Sleep------')
-            sleep_func(timer_start, timer_stop)
+            emit('sleep')
+            emit('resume', slept_s=sleep_func(sleep_schedule))
             if verbose > 0:
                 my_print('------Resume------')
 
-        if track in previous_tracks and len(audio_files) > list_len:
-            if verbose > 0:
-                my_print('Skipping "{}" in previously played tracks list...'
-                         .format(track))
-            if force_reload_list:
-                break
-
-        # fallback to checking last 3 played songs
-        elif track in previous_tracks[-3:] and len(audio_files) > 9:
-            if verbose > 0:
-                my_print('Skipping "{}" in last 3 '
-                         'previously played tracks list...'
-                         .format(track))
-            if force_reload_list:
-                break
-
-        # fallback to checking last played song
-        elif track in previous_tracks[-1] and len(audio_files) > 1:
-            if verbose > 0:
-                my_print('Skipping "{}" previously played track...'
-                         .format(track))
-            if force_reload_list:
-                break
+        if weekly_schedule:
+            prebuild_next_slot(weekly_schedule)
 
-        elif os.path.isfile(target):
+        if os.path.isfile(target):
 
             if playlist_mode:
                 my_print(track)
                 m3u_list.append(os.path.join(path, track))
             elif test_mode:
                 my_print(track)
+                finish_startup('first track')
                 time.sleep(0.1)
             else:
-                load_musicplayer(p, path, track, timer_start, timer_stop)
-
-            if list_len < 1:
-                pass
-            elif len(previous_tracks) < list_len:
-                previous_tracks.insert(list_len - 1, track)
-            else:
-                previous_tracks.append(track)
-                previous_tracks.pop(0)
+                next_tracks = [t for t in track_stream.peek(
+                    max(read_ahead_tracks, 1))
+                    if os.path.isfile(os.path.join(path, t))]
+                if read_ahead_tracks > 0:
+                    read_ahead.warm(os.path.join(path, t)
+                                    for t in next_tracks)
+                load_musicplayer(p, path, track, sleep_schedule,
+                                 next_tracks[0] if next_tracks else None)
+
+            if list_len > 0:
+                previous_tracks.add(track)
 
         elif verbose > 0:
             my_print('File "{}" Not Found. Skipping...'.format(track))
@@ -392,7 +904,7 @@ def main(p):
         open(os.path.join(path, 'playlist.m3u'), 'w').close()
         write_list_to_file(os.path.join(path, 'playlist.m3u'), m3u_list)
         if not test_mode:
-            load_musicplayer(p, path, 'playlist.m3u', timer_start, timer_stop)
+            load_musicplayer(p, path, 'playlist.m3u', sleep_schedule)
         else:
             my_print('playlist.m3u')
             time.sleep(2)
@@ -406,11 +918,18 @@ def main(p):
         raise SystemExit(0)
 
     if verbose > 0:
+        my_print(p.probe_cache.stats())
+        my_print(playlist_compiler.stats())
+        my_print('Player wakeups: {:.1f}/hour'.format(p.wakeups_per_hour()))
+        print_latency_summary()
         my_print('------Reload list------')
 
 
 if __name__ == '__main__':
 
+    startup = StartupProfile()
+    startup.mark('import')
+
     parser = argparse.ArgumentParser(
             prog='musicplayer',
             formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -425,6 +944,11 @@ if __name__ == '__main__':
                 Pause/Suspend.......Ctrl+Z
                 Skip tracks on cli..Ctrl+C (--ctrl-c)
 
+            Controls (--control SOCKET):
+                control.py SOCKET status|skip|pause|resume|stop|reload
+                control.py SOCKET enqueue TRACK
+                control.py SOCKET gain GAIN
+
             Controls (desktop vlc):
                 Stop/Next track.....Ctrl+Shift+X
                 Pause/Resume........Ctrl+Shift+P
@@ -443,15 +967,20 @@ if __name__ == '__main__':
                   playlist.
 
             '''), epilog='')
-    parser.add_argument('path', type=pathlib.Path,
+    parser.add_argument('path', type=pathlib.Path, nargs='?',
                         help='Audio files directory')
     parser.add_argument('-r', '--random', action='store_true',
                         help='Random playback')
+    parser.add_argument('-R', '--recursive', action='store_true',
+                        help='Include audio files in subdirectories')
     parser.add_argument('-p', '--player', choices=['vlc', 'ffplay'],
                         default='vlc', help='Default = vlc')
     parser.add_argument('-l', '--list-len', type=int, default=20,
                         help='Keep track of previously played audio files '
                         '\"default size = 20\"')
+    parser.add_argument('--history-file', type=str, default=None,
+                        help='Previously played tracks file shared by all '
+                        'invocations \"default = play_history.json\"')
     parser.add_argument('-g', '--gain', type=float, default=1.00,
                         help='Audio gain \"default GAIN = 1.00\"')
     parser.add_argument('-f', '--fade', type=float, default=0.00,
@@ -459,14 +988,29 @@ if __name__ == '__main__':
                         '\"default = 0.00\"')
     parser.add_argument('-c', '--ctrl-c', action='store_true',
                         help='Skip tracks with ctrl+c on cli')
-    parser.add_argument('-w', '--weight', type=int, default=1,
-                        help='WEIGHT*favorites.txt \"default WEIGHT = 1\"')
+    parser.add_argument('-w', '--weight', type=float, default=1.0,
+                        help='WEIGHT*favorites.txt \"default WEIGHT = 1\". '
+                        'Entries can set their own weight as '
+                        '\"track.mp3<TAB>2.5\"')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='Increase verbosity level')
-    parser.add_argument('-t', '--timer', metavar=('\"HH:MM\"', '\"HH:MM\"'),
-                        nargs=2, default=[None, None],
-                        help='Pause playback outside the specified time window'
-                        )
+    parser.add_argument('-t', '--timer',
+                        metavar=('\"HH:MM[:SS]\"', '\"HH:MM[:SS]\"'),
+                        nargs=2, action='append', default=None,
+                        help='Pause playback outside the specified time '
+                        'window. Repeat for several windows per day')
+    parser.add_argument('--schedule', type=str, default=None,
+                        metavar='FILE', help='Run as a daemon and switch '
+                        'libraries at the weekday/time slots of FILE '
+                        '(see musicplayer.schedule). Replaces path and -t')
+    parser.add_argument('--prebuild', type=float, default=300,
+                        metavar='SECONDS', help='Prepare the next schedule '
+                        'slot SECONDS before it starts \"default = 300\"')
+    parser.add_argument('--read-ahead', type=int, default=2,
+                        help='Warm the page cache for the next READ_AHEAD '
+                        'tracks \"default = 2\"')
+    parser.add_argument('--read-ahead-budget', type=int, default=32,
+                        help='Read-ahead budget in MiB \"default = 32\"')
     parser.add_argument('--wait', action='store_false',
                         help='Wait for track/playlist to finish before'
                         ' entering sleep mode')
@@ -492,6 +1036,26 @@ if __name__ == '__main__':
                         help='Log program output to musicplayer.log')
     parser.add_argument('--rename-log', type=str, default='musicplayer.log',
                         help='Rename log file')
+    parser.add_argument('--log-backups', type=int, default=0,
+                        help='Keep lines trimmed from the log file in N '
+                        'rotated files \"default = 0\"')
+    parser.add_argument('--log-gzip', action='store_true',
+                        help='Compress rotated log files')
+    parser.add_argument('--telemetry', type=str, default=None,
+                        metavar='FILE', help='Append playback events '
+                        '(start, end, skip, probe, sleep, resume, slot) to '
+                        'FILE as JSON lines')
+    parser.add_argument('--control', type=str, default=None,
+                        metavar='SOCKET', help='Accept commands (status, '
+                        'skip, pause, resume, stop, enqueue, gain, reload) '
+                        'on the Unix socket SOCKET, see control.py')
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='Print the time to first audio split into '
+                        'import, setup, scan, compile, probe, spawn and '
+                        'first audio')
+    parser.add_argument('--no-snapshot', action='store_true',
+                        help='Do not continue from or save the warm-start '
+                        'snapshot (snapshot.*.json)')
     parser.add_argument('--create-link', action='store_true',
                         help='Create a link to log file in audio files '
                         'directory')
@@ -501,19 +1065,38 @@ if __name__ == '__main__':
                         help='Terminate musicplayer when sleep mode activates')
     args = parser.parse_args()
 
+    weekly_schedule = None
+    if args.schedule is not None:
+        if args.path is not None or args.timer is not None:
+            parser.error('--schedule replaces path and -t/--timer')
+        try:
+            weekly_schedule = WeeklySchedule(args.schedule)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        if not weekly_schedule:
+            parser.error('{}: no slots'.format(args.schedule))
+        [parse_slot_options(slot) for slot in weekly_schedule.slots]
+        # libraries of the other slots are opened when first needed
+        args.path = (weekly_schedule.slot_at()
+                     or weekly_schedule.next_slot()).path
+    elif args.path is None:
+        parser.error('the following arguments are required: path')
+
     path = os.path.abspath(args.path)
     musicplayer = args.player
-    previous_tracks = ['a']  # skip previously played tracks
     list_len = abs(args.list_len)
-    force_reload_list = False  # force a list reload when a track is skipped
     gain = max(min(2, args.gain), 0)
     fade = max(min(7, args.fade), 0)
     random_mode = args.random
+    recursive = args.recursive
     skip_tracks = args.ctrl_c
     weight = abs(args.weight)
     verbose = args.verbose
     sort_files = args.sort_files
     test_mode = args.dry_run
+    # skip previously played tracks, shared with other invocations
+    previous_tracks = PlayHistory(list_len, args.history_file,
+                                  persist=not test_mode)
     no_reload = args.no_reload
     no_controls = args.no_controls
     playlist_mode = args.playlist
@@ -522,7 +1105,12 @@ if __name__ == '__main__':
     supported_audio_files = ['.mp3', '.wma', '.m4a',
                              '.webm', '.mkv', '.wav', '.mp4']
     supported_txt_files = ['.genre.txt']
-    start_time, stop_time = args.timer
+    sleep_schedule = SleepSchedule.from_strings(args.timer)
+    if weekly_schedule:
+        sleep_schedule = weekly_schedule
+    libraries = {}
+    prebuilt = set()
+    prebuild_time = abs(args.prebuild)
     force_kill_subprocess = args.wait
     loop_playback = args.loop
     repeat_track = args.repeat
@@ -532,13 +1120,29 @@ if __name__ == '__main__':
     link_file = os.path.join(path, log_file_name)
     disable_log_limit = False
     reset_log_at_startup = False
+    log_writer = None
+    telemetry = None
+    control = None
+    latency = LatencyStats()
     create_log_file_link = args.create_link
     enable_video = args.enable_video
     terminate = args.terminate
+    read_ahead_tracks = abs(args.read_ahead)
+    read_ahead = ReadAhead(abs(args.read_ahead_budget) * 1024 * 1024)
     disable_fade = ((enable_video or not no_controls or playlist_mode)
                     or (loop_playback or repeat_track))
 
+    startup_profile = args.startup_profile
+    warm_start = None
+    if not (args.no_snapshot or test_mode or playlist_mode):
+        # arguments that only change the output keep the snapshot
+        warm_start = Snapshot(repr(sorted(
+                (k, str(v)) for k, v in vars(args).items()
+                if k not in ('verbose', 'startup_profile'))))
+
     p = Musicplayer(gain, supported_audio_files)
+    if warm_start is not None:
+        p.probe_cache.preload(warm_start.probes())
 
     if musicplayer == 'vlc':
         p.set_vlc(
@@ -552,15 +1156,49 @@ if __name__ == '__main__':
                 loop=(loop_playback or repeat_track),
                 enable_video=enable_video)
 
-    flag = False
-    sort_file_lists(path)
+    if not disable_fade:
+        p.set_fade(fade)
 
-    if enable_log and not os.path.exists(log_file):
-        open(log_file, 'w').close()
+    flag = False
+    startup.mark('setup')
+    watcher, library_index = open_library(path, recursive)
+    startup.mark('scan')
+    # keep the compiled playlists of every slot library
+    playlist_compiler = PlaylistCompiler(
+            supported_audio_files,
+            len(weekly_schedule.slots) + 1 if weekly_schedule else 1)
+    # end the cycle and reload the list when a track is skipped
+    force_reload_list = False
+    track_stream = TrackStream(playlist_compiler, previous_tracks, list_len,
+                               reload_on_skip=force_reload_list)
+    track_stream.on_skip = log_skip
 
     if reset_log_at_startup and os.path.exists(log_file):
         open(log_file, 'w').close()
 
+    if enable_log:
+        log_writer = LogWriter(log_file, 400, 2000,
+                               limit=not disable_log_limit,
+                               backups=abs(args.log_backups),
+                               compress=args.log_gzip)
+
+    if args.telemetry is not None:
+        telemetry = Telemetry(args.telemetry, backend=musicplayer,
+                              path=path, dry_run=test_mode)
+
+    if args.control is not None:
+        try:
+            control = ControlServer(args.control)
+        except (OSError, RuntimeError) as e:
+            parser.error(str(e))
+        p.add_reader(control)
+        sleep_schedule.wait = control_sleep
+
+    atexit.register(print_latency_summary)
+    atexit.register(save_snapshot)
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    startup.mark('setup')
+
     if verbose > 0:
         my_print('------Start------')
 
@@ -569,14 +1207,28 @@ if __name__ == '__main__':
 
     try:
         while True:
-            if get_audio_files(path, supported_audio_files):
+            if weekly_schedule and weekly_schedule.changed():
+                slot, options = switch_slot(weekly_schedule)
+                path = slot.path
+                link_file = os.path.join(path, log_file_name)
+                random_mode = options.random
+                recursive = options.recursive
+                weight = abs(options.weight)
+                fade = max(min(7, options.fade), 0)
+                force_kill_subprocess = options.wait
+                watcher, library_index = open_library(path, recursive)
+                p.set_gain(max(min(2, options.gain), 0))
+                if not disable_fade:
+                    p.set_fade(fade)
+                flag = False
+            if get_library_files():
                 main(p)
                 flag = False
             elif not flag:
                 my_print('Playlist is empty. Waiting for files')
                 flag = True
             else:
-                time.sleep(1)
+                watcher.wait_for_change(get_idle_timeout())
     except KeyboardInterrupt:
         my_print('Program interrupted')
         raise SystemExit(0)
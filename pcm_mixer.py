@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import resource
+import argparse
+import threading
+import subprocess
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+sample_width = 2  # s16le
+
+
+class PcmVoice:
+
+    def __init__(self, mixer, audio_file, gain=1.0):
+        self.audio_file = audio_file
+        self.gain = gain
+        self.position = 0
+        self.fade_in_frames = 0
+        self.fade_out_frames = 0
+        self.end_frame = None
+        self.returncode = None
+        self.started = False
+        self._stopped = False
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._done_r, self._done_w = os.pipe()
+        self._decoder = subprocess.Popen([
+            'ffmpeg',
+            '-v',
+            'error',
+            '-i',
+            audio_file,
+            '-f',
+            's16le',
+            '-ac',
+            str(mixer.channels),
+            '-ar',
+            str(mixer.sample_rate),
+            '-'
+        ], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        self.pid = self._decoder.pid
+
+    def set_envelope(self, sample_rate, duration=None, fade=0.0):
+        fade_frames = int(fade * sample_rate)
+        self.fade_in_frames = fade_frames
+        self.fade_out_frames = fade_frames
+        if duration is not None:
+            self.end_frame = int(duration * sample_rate)
+
+    def read(self, size):
+        data = b''
+        while len(data) < size and not self._stopped:
+            chunk = self._decoder.stdout.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def envelope(self, frames):
+        positions = np.arange(self.position, self.position + frames,
+                              dtype=np.float32)
+        gain = np.full(frames, self.gain, dtype=np.float32)
+        if self.fade_in_frames > 0:
+            gain *= np.clip(positions / self.fade_in_frames, 0, 1)
+        if self.fade_out_frames > 0 and self.end_frame is not None:
+            gain *= np.clip((self.end_frame - positions)
+                            / self.fade_out_frames, 0, 1)
+        return gain
+
+    def finish(self):
+        with self._lock:
+            if self._done.is_set():
+                return None
+            self._decoder.stdout.close()
+            if self._stopped:
+                self._decoder.kill()
+            self.returncode = self._decoder.wait()
+            os.write(self._done_w, b'\0')
+            os.close(self._done_w)
+            self._done.set()
+
+    def fileno(self):
+        return self._done_r
+
+    def poll(self):
+        if self._done.is_set():
+            return self.returncode
+        return None
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.poll()
+
+    def kill(self):
+        self._stopped = True
+        if self._decoder.poll() is None:
+            self._decoder.kill()
+        if not self.started:
+            self.finish()
+
+    def close(self):
+        self.kill()
+        if self._done_r is not None:
+            os.close(self._done_r)
+            self._done_r = None
+
+
+class PcmMixer:
+
+    def __init__(self, sink='aplay', device='default', sample_rate=44100,
+                 channels=2, block_frames=2048, idle_timeout=2.0):
+        if np is None:
+            raise RuntimeError('pcm backend requires numpy')
+        self.sink = sink
+        self.device = device
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.block_frames = block_frames
+        self.idle_timeout = idle_timeout
+        self.frames_written = 0
+        self.underruns = 0
+        self._voices = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._sink_process = None
+        self._sink_file = None
+        self._running = False
+
+    def __sink_args(self):
+        if self.sink == 'aplay':
+            return ['aplay', '-q', '-t', 'raw', '-f', 'S16_LE',
+                    '-r', str(self.sample_rate), '-c', str(self.channels),
+                    '-D', self.device]
+        return ['ffmpeg', '-v', 'error', '-f', 's16le',
+                '-ar', str(self.sample_rate), '-ac', str(self.channels),
+                '-i', '-', '-f', 'alsa', self.device]
+
+    def start(self):
+        if self._running:
+            return None
+        if self.sink in ('aplay', 'ffmpeg'):
+            self._sink_process = subprocess.Popen(
+                    self.__sink_args(), stdin=subprocess.PIPE,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self._sink_file = self._sink_process.stdin
+        elif self.sink != 'null':
+            self._sink_file = open(self.sink, 'wb')
+        self._running = True
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def open_voice(self, audio_file, gain=1.0):
+        return PcmVoice(self, audio_file, gain)
+
+    def start_voice(self, voice, duration=None, fade=0.0):
+        voice.set_envelope(self.sample_rate, duration, fade)
+        voice.started = True
+        with self._condition:
+            self._voices.append(voice)
+            self._condition.notify()
+        return voice
+
+    def play(self, audio_file, gain=1.0, duration=None, fade=0.0):
+        return self.start_voice(
+                self.open_voice(audio_file, gain), duration, fade)
+
+    def set_gain(self, gain):
+        with self._condition:
+            for voice in self._voices:
+                voice.gain = gain
+
+    def __write(self, block):
+        self.frames_written += len(block)
+        if self._sink_file is not None:
+            self._sink_file.write(block.tobytes())
+
+    def __mix_block(self, voices):
+        block_size = self.block_frames * self.channels * sample_width
+        mix = np.zeros((self.block_frames, self.channels), dtype=np.float32)
+        for voice in voices:
+            data = voice.read(block_size)
+            frames = len(data) // (self.channels * sample_width)
+            if frames > 0:
+                samples = np.frombuffer(
+                        data[:frames * self.channels * sample_width],
+                        dtype='<i2').reshape(frames, self.channels)
+                mix[:frames] += samples * voice.envelope(frames)[:, None]
+                voice.position += frames
+            if frames < self.block_frames:
+                voice.finish()
+        return np.clip(mix, -32768, 32767).astype('<i2')
+
+    def __run(self):
+        silence = np.zeros((self.block_frames, self.channels), dtype='<i2')
+        idle_since = None
+        while self._running:
+            with self._condition:
+                self._voices = [v for v in self._voices if v.poll() is None]
+                voices = list(self._voices)
+                if not voices:
+                    if idle_since is None:
+                        idle_since = time.monotonic()
+                    # keep the sink fed for short gaps, then block
+                    if self._sink_process is None or time.monotonic() \
+                            - idle_since > self.idle_timeout:
+                        self._condition.wait()
+                        continue
+                    self._condition.wait(
+                            self.block_frames / self.sample_rate / 2)
+                    voices = list(self._voices)
+            try:
+                if voices:
+                    idle_since = None
+                    self.__write(self.__mix_block(voices))
+                else:
+                    self.underruns += 1
+                    self.__write(silence)
+            except (BrokenPipeError, ValueError):
+                self._running = False
+        with self._condition:
+            for voice in self._voices:
+                voice.kill()
+                voice.finish()
+
+    def close(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if self._sink_file is not None:
+            try:
+                self._sink_file.close()
+            except BrokenPipeError:
+                pass
+        if self._sink_process is not None:
+            self._sink_process.wait()
+
+
+def benchmark_mixer(audio_files, fade):
+    mixer = PcmMixer(sink='null')
+    mixer.start()
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    for audio_file in audio_files:
+        voice = mixer.play(audio_file, fade=fade)
+        voice.wait()
+        voice.close()
+    mixer.close()
+    return (time.process_time() - cpu_start, time.monotonic() - wall_start,
+            mixer.frames_written / mixer.sample_rate)
+
+
+def benchmark_ffplay(audio_files):
+    wall_start = time.monotonic()
+    for audio_file in audio_files:
+        subprocess.run(['ffplay', '-nodisp', '-autoexit', '-af', 'volume=1.0',
+                        audio_file], stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+    return 0.0, time.monotonic() - wall_start, None
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='pcm mixer',
+            description='Measure CPU time per hour of audio for the pcm '
+            'mixer backend and ffplay', epilog='')
+    parser.add_argument('files', nargs='+', help='Audio files')
+    parser.add_argument('-b', '--backend', choices=['pcm', 'ffplay'],
+                        default='pcm', help='Backend to measure')
+    parser.add_argument('-f', '--fade', type=float, default=0.0,
+                        help='Fade (seconds) applied to every voice')
+    args = parser.parse_args()
+
+    try:
+        if args.backend == 'pcm':
+            cpu, wall, audio = benchmark_mixer(args.files, args.fade)
+        else:
+            cpu, wall, audio = benchmark_ffplay(args.files)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu += children.ru_utime + children.ru_stime
+        if audio is None:
+            audio = wall
+        print('{}: {:.1f} s audio, {:.2f} s wall, {:.2f} s cpu, '
+              '{:.1f} cpu s/hour of audio'.format(
+                  args.backend, audio, wall, cpu, cpu * 3600 / max(audio, 1)))
+    except KeyboardInterrupt:
+        print('Program interrupted')
+        raise SystemExit(0)
+    except Exception as e:
+        print('Exception encountered:', e)
+        raise SystemExit(1)
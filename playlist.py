@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import random
+import argparse
+import tempfile
+
+
+def read_list(file, file_extensions):
+    file_extensions = tuple(file_extensions)
+    audio_files = []
+    if os.path.isfile(file):
+        with open(file, 'r', encoding='utf-8') as fp:
+            audio_files = [line.rstrip() for line in fp
+                           if line.rstrip().endswith(file_extensions)]
+            audio_files.sort()
+    return audio_files
+
+
+def read_weighted_list(file, file_extensions):
+    # favorites.txt lines are "track" or "track<TAB>weight"
+    file_extensions = tuple(file_extensions)
+    entries = []
+    if os.path.isfile(file):
+        with open(file, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                track, _, weight = line.rstrip().partition('\t')
+                if not track.endswith(file_extensions):
+                    continue
+                try:
+                    weight = float(weight) if weight else 1.0
+                except ValueError:
+                    weight = 1.0
+                entries.append((track, weight))
+            entries.sort()
+    return entries
+
+
+class AliasSampler:
+
+    def __init__(self, items, weights):
+        # Vose's alias method: O(n) build, O(1) sample
+        self.items = items
+        size = len(items)
+        self.probability = [0.0] * size
+        self.alias = [0] * size
+        total = sum(weights)
+        if size == 0 or total <= 0:
+            return None
+        scaled = [w * size / total for w in weights]
+        small = [i for i, w in enumerate(scaled) if w < 1.0]
+        large = [i for i, w in enumerate(scaled) if w >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        for i in small + large:
+            self.probability[i] = 1.0
+
+    def __len__(self):
+        return len(self.items)
+
+    def sample(self, rng=random):
+        index = rng.randrange(len(self.items))
+        if rng.random() < self.probability[index]:
+            return self.items[index]
+        return self.items[self.alias[index]]
+
+
+def legacy_tracklist(filepath, audio_files, genre_files, random_mode, weight,
+                     extensions, rng=random):
+    # get_tracklist() before the compiler, kept for --verify and --benchmark
+    track_list = list(audio_files)
+    if random_mode:
+        weight_list = read_list(
+                os.path.join(filepath, 'favorites.txt'), extensions)
+        track_list.extend(item for item in weight_list for _ in range(weight))
+        rng.shuffle(track_list)
+        if not genre_files:
+            return track_list
+        for file in genre_files:
+            genre_list = read_list(os.path.join(filepath, file), extensions)
+            track_list = [item for item in track_list
+                          if item not in genre_list]
+            rng.shuffle(genre_list)
+            track_list.extend(genre_list)
+    elif genre_files:
+        temp_list = []
+        for file in genre_files:
+            genre_list = read_list(os.path.join(filepath, file), extensions)
+            track_list = list(set(track_list) - set(genre_list))
+            genre_list = list(set(genre_list))
+            genre_list.sort()
+            temp_list.extend(genre_list)
+        track_list.sort()
+        track_list.extend(temp_list)
+    return track_list
+
+
+class CompiledPlaylist:
+
+    def __init__(self, audio_files, favorites, weight, genre_lists,
+                 random_mode):
+        self.audio_files = audio_files
+        self.favorites = [(t, w * weight) for t, w in favorites if w > 0]
+        self.genre_lists = genre_lists
+        self.random_mode = random_mode
+        self.pool_size = len(audio_files) + round(
+                sum(w for _, w in self.favorites))
+        # a track ends up in the last genre group that lists it
+        self.last_group = {}
+        for group, genre_list in enumerate(genre_lists):
+            for track in genre_list:
+                self.last_group[track] = group
+        self.sorted_list = None
+        self._segments = None
+        if not random_mode:
+            self.sorted_list = self.__sorted_list()
+
+    def __sorted_list(self):
+        if not self.genre_lists:
+            return list(self.audio_files)
+        track_list = sorted(set(self.audio_files) - self.last_group.keys())
+        for genre_list in self.genre_lists:
+            track_list.extend(sorted(set(genre_list)))
+        return track_list
+
+    def tracklist(self, rng=random):
+        if self.sorted_list is not None:
+            return list(self.sorted_list)
+        # same shuffle calls, on lists of the same length, as the legacy
+        # filter loop so a seeded rng gives the same order
+        track_list = self.audio_files + [
+                t for t, w in self.favorites for _ in range(round(w))]
+        rng.shuffle(track_list)
+        if not self.genre_lists:
+            return track_list
+        last_group = self.last_group
+        track_list = [t for t in track_list if t not in last_group]
+        for group, genre_list in enumerate(self.genre_lists):
+            genre_list = list(genre_list)
+            rng.shuffle(genre_list)
+            track_list.extend(t for t in genre_list
+                              if last_group[t] == group)
+        return track_list
+
+    def segments(self):
+        # (tracks, favorites sampler, favorite plays) per group, with the
+        # genre filtering of tracklist() already applied, for TrackStream
+        if self._segments is not None:
+            return self._segments
+        if self.sorted_list is not None:
+            self._segments = [(self.sorted_list, None, 0.0)]
+            return self._segments
+        last_group = self.last_group
+        favorites = [(t, w) for t, w in self.favorites
+                     if t not in last_group]
+        self._segments = [(
+            [t for t in self.audio_files if t not in last_group],
+            AliasSampler([t for t, _ in favorites],
+                         [w for _, w in favorites]),
+            sum(w for _, w in favorites))]
+        for group, genre_list in enumerate(self.genre_lists):
+            self._segments.append((
+                [t for t in genre_list if last_group[t] == group], None, 0.0))
+        return self._segments
+
+
+class Segment:
+
+    def __init__(self, tracks, favorites=None, plays=0.0, rng=None):
+        # sparse Fisher-Yates over the tracks, interleaved with `plays`
+        # favorites drawn from the weighted sampler
+        self.tracks = tracks
+        self.favorites = favorites
+        self.plays = 0
+        if favorites and rng is not None:
+            self.plays = int(plays) + (rng.random() < plays - int(plays))
+        self.rng = rng
+        self.added = []
+        self.length = len(tracks)
+        self.remaining = self.length + self.plays
+        self._left = self.length
+        self._swaps = {}
+
+    def __track(self, index):
+        if index < len(self.tracks):
+            return self.tracks[index]
+        return self.added[index - len(self.tracks)]
+
+    def add(self, track):
+        self.added.append(track)
+        if self.rng is not None:
+            self._swaps[self._left] = self.length
+        self.length += 1
+        self._left += 1
+        self.remaining += 1
+
+    def draw(self):
+        if self.remaining == 0:
+            return None
+        self.remaining -= 1
+        if self.rng is None:
+            self._left -= 1
+            return self.__track(self.length - self._left - 1)
+        # a favorite with the probability of hitting one of its slots in a
+        # full shuffle, so the repeated slots never have to be stored
+        if self.rng.randrange(self.remaining + 1) < self.plays:
+            self.plays -= 1
+            return self.favorites.sample(self.rng)
+        position = self.rng.randrange(self._left)
+        last = self._left - 1
+        index = self._swaps.get(position, position)
+        self._swaps[position] = self._swaps.pop(last, last)
+        self._left -= 1
+        return self.__track(index)
+
+    def state(self):
+        favorites = None
+        if self.favorites is not None:
+            favorites = [self.favorites.items, self.favorites.probability,
+                         self.favorites.alias]
+        return {'tracks': self.tracks, 'added': self.added,
+                'favorites': favorites, 'plays': self.plays,
+                'shuffled': self.rng is not None, 'length': self.length,
+                'remaining': self.remaining, 'left': self._left,
+                'swaps': list(self._swaps.items())}
+
+    @classmethod
+    def from_state(cls, state, rng=random):
+        favorites = None
+        if state['favorites'] is not None:
+            items, probability, alias = state['favorites']
+            favorites = AliasSampler(items, [])
+            favorites.probability, favorites.alias = probability, alias
+        segment = cls(state['tracks'], favorites)
+        segment.rng = rng if state['shuffled'] else None
+        segment.plays = state['plays']
+        segment.added = state['added']
+        segment.length = state['length']
+        segment.remaining = state['remaining']
+        segment._left = state['left']
+        segment._swaps = dict(state['swaps'])
+        return segment
+
+
+class PlaylistCompiler:
+
+    def __init__(self, extensions, cache_size=1):
+        self.extensions = tuple(extensions)
+        self.cache_size = max(cache_size, 1)
+        self.compiles = 0
+        self.hits = 0
+        # key -> (audio_files, compiled), least recently used first
+        self._cache = {}
+
+    def __key(self, filepath, genre_files, random_mode, weight):
+        stats = []
+        for file in [''] + list(genre_files) + ['favorites.txt']:
+            try:
+                stat = os.stat(os.path.join(filepath, file))
+                stats.append((file, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                stats.append((file, None, None))
+        return (filepath, tuple(stats), random_mode, weight)
+
+    def compile(self, filepath, audio_files, genre_files, random_mode,
+                weight):
+        key = self.__key(filepath, genre_files, random_mode, weight)
+        entry = self._cache.pop(key, None)
+        if entry is not None and audio_files == entry[0]:
+            self._cache[key] = entry
+            self.hits += 1
+            return entry[1]
+        favorites = []
+        if random_mode:
+            favorites = read_weighted_list(
+                    os.path.join(filepath, 'favorites.txt'), self.extensions)
+        genre_lists = [read_list(os.path.join(filepath, file),
+                                 self.extensions) for file in genre_files]
+        compiled = CompiledPlaylist(
+                list(audio_files), favorites, weight, genre_lists,
+                random_mode)
+        self._cache[key] = (list(audio_files), compiled)
+        while len(self._cache) > self.cache_size:
+            del self._cache[next(iter(self._cache))]
+        self.compiles += 1
+        return compiled
+
+    def tracklist(self, filepath, audio_files, genre_files, random_mode,
+                  weight, rng=random):
+        return self.compile(filepath, audio_files, genre_files, random_mode,
+                            weight).tracklist(rng)
+
+    def stats(self):
+        return 'Playlist compiler: {} compiled, {} cached'.format(
+                self.compiles, self.hits)
+
+
+class TrackStream:
+
+    def __init__(self, compiler, history=None, list_len=0, rng=random,
+                 source=None, reload_on_skip=False):
+        self.compiler = compiler
+        self.history = history
+        self.list_len = list_len
+        self.rng = rng
+        # source() -> (filepath, audio_files, genre_files, random_mode,
+        # weight), used to start the next cycle when iterated endlessly
+        self.source = source
+        self.reload_on_skip = reload_on_skip
+        self.on_skip = None
+        self.cycles = 0
+        self.skipped = 0
+        self.current = None
+        self.pool_size = 0
+        self._segments = []
+        self._buffer = []
+        # tracks requested with enqueue(), played before the drawn ones
+        self._queue = []
+
+    def start(self, filepath, audio_files, genre_files, random_mode, weight):
+        compiled = self.compiler.compile(
+                filepath, audio_files, genre_files, random_mode, weight)
+        rng = self.rng if random_mode else None
+        self._segments = [Segment(tracks, favorites, plays, rng)
+                          for tracks, favorites, plays
+                          in compiled.segments()]
+        self._buffer = []
+        self.pool_size = compiled.pool_size
+        self.cycles += 1
+
+    def add(self, track):
+        # tracks added mid-cycle join the segment being played
+        self.pool_size += 1
+        if not self._segments:
+            self._segments = [Segment([], rng=None)]
+        segment = self._segments[0]
+        if segment.rng is None:
+            segment = self._segments[-1]
+        segment.add(track)
+
+    def state(self):
+        # enough to continue the cycle in a new process
+        return {'segments': [s.state() for s in self._segments],
+                'buffer': self._buffer, 'queue': self._queue,
+                'current': self.current, 'pool_size': self.pool_size}
+
+    def restore(self, state):
+        self._segments = [Segment.from_state(s, self.rng)
+                          for s in state['segments']]
+        self._buffer = list(state['buffer'])
+        self._queue = list(state['queue'])
+        self.current = state['current']
+        self.pool_size = state['pool_size']
+        self.cycles += 1
+
+    def enqueue(self, track):
+        self._queue.append(track)
+
+    def reload(self):
+        # end the cycle once the queued tracks have played
+        self._segments = []
+        self._buffer = []
+
+    def skip_reason(self, track):
+        history = self.history
+        if history is None or self.list_len < 1:
+            return None
+        # the current track only reaches the history once it has played
+        current = track == self.current
+        if (current or track in history) and self.pool_size > self.list_len:
+            return 'in previously played tracks list'
+        if (current or history.recent(track, 3)) and self.pool_size > 9:
+            return 'in last 3 previously played tracks list'
+        if (current or history.last() == track) and self.pool_size > 1:
+            return 'previously played track'
+        return None
+
+    def __draw(self):
+        while self._segments:
+            track = self._segments[0].draw()
+            if track is not None:
+                return track
+            self._segments.pop(0)
+        return None
+
+    def __next_eligible(self, pending):
+        while True:
+            track = self.__draw()
+            if track is None:
+                return None
+            reason = self.skip_reason(track)
+            if reason is None and track in pending:
+                reason = 'already queued'
+            if reason is None:
+                return track
+            self.skipped += 1
+            if self.on_skip is not None:
+                self.on_skip(track, reason)
+            if self.reload_on_skip:
+                self._segments = []
+                return None
+
+    def peek(self, count):
+        while len(self._queue) + len(self._buffer) < count:
+            track = self.__next_eligible(self._buffer)
+            if track is None:
+                break
+            self._buffer.append(track)
+        return (self._queue + self._buffer)[:count]
+
+    def next_track(self):
+        if self._queue:
+            self.current = self._queue.pop(0)
+            return self.current
+        while self._buffer:
+            track = self._buffer.pop(0)
+            # history may have changed since the track was peeked
+            if self.skip_reason(track) is None:
+                self.current = track
+                return track
+        track = self.__next_eligible(())
+        if track is not None:
+            self.current = track
+        return track
+
+    def cycle(self):
+        while True:
+            track = self.next_track()
+            if track is None:
+                return None
+            yield track
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        track = self.next_track()
+        if track is None and self.source is not None:
+            self.start(*self.source())
+            track = self.next_track()
+        if track is None:
+            raise StopIteration
+        return track
+
+
+def create_synthetic_library(directory, track_count, genre_count=12,
+                             genre_share=0.02, favorites_share=0.01):
+    audio_files = ['track{:06d}.mp3'.format(i) for i in range(track_count)]
+    rng = random.Random(track_count)
+    genre_files = []
+    for genre in range(genre_count):
+        genre_file = 'genre{:02d}.genre.txt'.format(genre)
+        genre_files.append(genre_file)
+        with open(os.path.join(directory, genre_file), 'w') as fp:
+            fp.writelines(t + '\n' for t in rng.sample(
+                audio_files, max(int(track_count * genre_share), 1)))
+    with open(os.path.join(directory, 'favorites.txt'), 'w') as fp:
+        fp.writelines(t + '\n' for t in rng.sample(
+            audio_files, max(int(track_count * favorites_share), 1)))
+    return audio_files, genre_files
+
+
+def verify(track_counts, extensions, weight=2):
+    for track_count in track_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            audio_files, genre_files = create_synthetic_library(
+                    directory, track_count)
+            for random_mode in (False, True):
+                for genres in (genre_files, []):
+                    compiler = PlaylistCompiler(extensions)
+                    expected = legacy_tracklist(
+                            directory, audio_files, genres, random_mode,
+                            weight, extensions, random.Random(1))
+                    result = compiler.tracklist(
+                            directory, audio_files, genres, random_mode,
+                            weight, random.Random(1))
+                    print('{:>7} tracks, random={!s:<5}, genres={:<2}: {}'
+                          .format(track_count, random_mode, len(genres),
+                                  'ok' if result == expected else 'MISMATCH'))
+                    if result != expected:
+                        return False
+    return verify_sampler([0.5, 1.0, 2.5, 4.0, 0.1])
+
+
+def verify_sampler(weights, samples=500000, tolerance=0.02):
+    sampler = AliasSampler(list(range(len(weights))), weights)
+    rng = random.Random(1)
+    counts = [0] * len(weights)
+    for _ in range(samples):
+        counts[sampler.sample(rng)] += 1
+    result = True
+    for weight, count in zip(weights, counts):
+        expected = weight / sum(weights)
+        observed = count / samples
+        ok = abs(observed - expected) <= tolerance * max(expected, 0.05)
+        result = result and ok
+        print('weight {:>4}: expected {:.4f}, sampled {:.4f}: {}'.format(
+            weight, expected, observed, 'ok' if ok else 'MISMATCH'))
+    return result
+
+
+def benchmark(track_counts, extensions, legacy_limit, weight=2):
+    print('{:>7} {:>10} {:>10} {:>10} {:>10}'.format(
+        'tracks', 'legacy s', 'compile s', 'cached s', 'ordered s'))
+    for track_count in track_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            audio_files, genre_files = create_synthetic_library(
+                    directory, track_count)
+            legacy = '-'
+            if track_count <= legacy_limit:
+                start = time.perf_counter()
+                legacy_tracklist(directory, audio_files, genre_files, True,
+                                 weight, extensions)
+                legacy = '{:.3f}'.format(time.perf_counter() - start)
+            compiler = PlaylistCompiler(extensions)
+            start = time.perf_counter()
+            compiler.tracklist(directory, audio_files, genre_files, True,
+                               weight)
+            compiled = time.perf_counter() - start
+            start = time.perf_counter()
+            compiler.tracklist(directory, audio_files, genre_files, True,
+                               weight)
+            cached = time.perf_counter() - start
+            start = time.perf_counter()
+            compiler.tracklist(directory, audio_files, genre_files, False,
+                               weight)
+            ordered = time.perf_counter() - start
+            print('{:>7} {:>10} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                track_count, legacy, compiled, cached, ordered))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='playlist',
+            description='Playlist compiler benchmark and parity check',
+            epilog='')
+    parser.add_argument('--verify', action='store_true',
+                        help='Compare compiler output with the legacy '
+                        'get_tracklist on seeded synthetic libraries')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Time legacy and compiled tracklists')
+    parser.add_argument('--tracks', type=int, nargs='+',
+                        default=[1000, 10000, 50000, 100000, 500000],
+                        help='Synthetic library sizes')
+    parser.add_argument('--legacy-limit', type=int, default=50000,
+                        help='Skip the legacy implementation above this '
+                        'library size')
+    args = parser.parse_args()
+
+    supported_audio_files = ('.mp3', '.wma', '.m4a',
+                             '.webm', '.mkv', '.wav', '.mp4')
+
+    try:
+        if args.verify and not verify(args.tracks, supported_audio_files):
+            raise SystemExit(1)
+        if args.benchmark:
+            benchmark(args.tracks, supported_audio_files, args.legacy_limit)
+    except KeyboardInterrupt:
+        print('Program interrupted')
+        raise SystemExit(0)
+    except Exception as e:
+        print('Exception encountered:', e)
+        raise SystemExit(1)
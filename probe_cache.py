@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import subprocess
+import threading
+import argparse
+from audio_header import read_audio_header
+
+
+probe_fields = ['duration', 'bit_rate', 'sample_rate', 'codec_name',
+                'channels']
+# bumped when header parsing changes, entries of older versions are dropped
+probe_cache_version = 3
+
+
+def parse_probe_value(key, value):
+    if value in ('', 'N/A'):
+        return None
+    if key == 'duration':
+        return float(value)
+    if key in ('bit_rate', 'sample_rate', 'channels'):
+        return int(value)
+    return value
+
+
+def probe_file(audio_file):
+    result = subprocess.run([
+        'ffprobe',
+        '-v',
+        'error',
+        '-select_streams',
+        'a:0',
+        '-show_entries',
+        'format=duration:stream=bit_rate,sample_rate,codec_name,channels',
+        '-of',
+        'default=noprint_wrappers=1',
+        audio_file
+    ], capture_output=True, text=True)
+    info = dict.fromkeys(probe_fields)
+    for line in result.stdout.splitlines():
+        key, _, value = line.partition('=')
+        if key in info and info[key] is None:
+            info[key] = parse_probe_value(key, value.strip())
+    return info
+
+
+class ProbeCache:
+
+    def __init__(self, cache_file=None):
+        if cache_file is None:
+            cache_file = os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    'probe_cache.db')
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+        self.parsed = 0
+        self.last_source = None
+        # entries preloaded from a warm-start snapshot
+        self._memory = {}
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is not None:
+            return self._db
+        try:
+            self._db = sqlite3.connect(
+                    self.cache_file, timeout=5, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.Error:
+            self._db = sqlite3.connect(':memory:', check_same_thread=False)
+        if self._db.execute('PRAGMA user_version').fetchone()[0] \
+                != probe_cache_version:
+            self._db.execute('DROP TABLE IF EXISTS probe')
+            self._db.execute('PRAGMA user_version = {}'.format(
+                probe_cache_version))
+        self._db.execute(
+                'CREATE TABLE IF NOT EXISTS probe ('
+                'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                'duration REAL, bit_rate INTEGER, sample_rate INTEGER, '
+                'codec_name TEXT, channels INTEGER)')
+        return self._db
+
+    def lookup(self, audio_file, stat=None):
+        path = os.path.abspath(audio_file)
+        if stat is None:
+            stat = os.stat(path)
+        entry = self._memory.get(path)
+        if entry is not None and entry[0] == stat.st_size \
+                and entry[1] == stat.st_mtime_ns:
+            return dict(entry[2])
+        with self._lock:
+            row = self._connect().execute(
+                    'SELECT size, mtime_ns, {} FROM probe WHERE path = ?'
+                    .format(', '.join(probe_fields)), (path,)).fetchone()
+        if row is None or row[0] != stat.st_size \
+                or row[1] != stat.st_mtime_ns:
+            return None
+        return dict(zip(probe_fields, row[2:]))
+
+    def store(self, audio_file, info, stat=None):
+        path = os.path.abspath(audio_file)
+        if stat is None:
+            stat = os.stat(path)
+        with self._lock:
+            db = self._connect()
+            try:
+                db.execute(
+                        'INSERT OR REPLACE INTO probe VALUES '
+                        '(?, ?, ?, ?, ?, ?, ?, ?)',
+                        (path, stat.st_size, stat.st_mtime_ns)
+                        + tuple(info.get(key) for key in probe_fields))
+                db.commit()
+            except sqlite3.Error:
+                db.rollback()
+
+    def get(self, audio_file):
+        stat = os.stat(audio_file)
+        info = self.lookup(audio_file, stat)
+        if info is not None:
+            self.hits += 1
+            self.last_source = 'cache'
+            return info
+        self.misses += 1
+        info = read_audio_header(audio_file)
+        if info is not None:
+            self.parsed += 1
+            self.last_source = 'header'
+        else:
+            info = probe_file(audio_file)
+            self.last_source = 'ffprobe'
+        if info['duration'] is not None:
+            self.store(audio_file, info, stat)
+        return info
+
+    def preload(self, entries):
+        for path, size, mtime_ns, info in entries:
+            self._memory[path] = (size, mtime_ns, info)
+
+    def export(self, audio_files):
+        # [path, size, mtime_ns, info] of cached files, for preload()
+        entries = []
+        for audio_file in audio_files:
+            try:
+                stat = os.stat(audio_file)
+                info = self.lookup(audio_file, stat)
+            except OSError:
+                continue
+            if info is not None:
+                entries.append([os.path.abspath(audio_file), stat.st_size,
+                                stat.st_mtime_ns, info])
+        return entries
+
+    def get_duration(self, audio_file):
+        return float(self.get(audio_file)['duration'])
+
+    def stats(self):
+        return 'Probe cache: {} hits, {} misses ({} read from headers)' \
+                .format(self.hits, self.misses, self.parsed)
+
+    def prune(self):
+        with self._lock:
+            db = self._connect()
+            paths = [row[0] for row in db.execute('SELECT path FROM probe')]
+            stale = [(p,) for p in paths if not os.path.isfile(p)]
+            db.executemany('DELETE FROM probe WHERE path = ?', stale)
+            db.commit()
+        return len(stale)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='probe cache',
+            description='Inspect the media probe cache shared by musicplayer '
+            'and convert2mp3', epilog='')
+    parser.add_argument('files', nargs='*', help='Audio files to probe')
+    parser.add_argument('--prune', action='store_true',
+                        help='Remove entries for files that no longer exist')
+    args = parser.parse_args()
+
+    cache = ProbeCache()
+    try:
+        if args.prune:
+            print('Removed {} stale entries'.format(cache.prune()))
+        for file in args.files:
+            info = cache.get(file)
+            print(' '.join(str(info[key]) for key in probe_fields), file)
+        print(cache.stats())
+    except KeyboardInterrupt:
+        print('Program interrupted')
+        raise SystemExit(0)
+    except Exception as e:
+        print('Exception encountered:', e)
+        raise SystemExit(1)
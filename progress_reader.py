@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import time
+import bisect
+import threading
+
+
+ffplay_status = re.compile(rb'^\s*(-?\d+\.\d+)\s')
+
+
+def parse_ffplay_line(line):
+    match = ffplay_status.match(line)
+    if match is None:
+        return None
+    return float(match.group(1))
+
+
+def parse_ffmpeg_line(line):
+    key, _, value = line.strip().partition(b'=')
+    if key not in (b'out_time_us', b'out_time_ms'):
+        return None
+    try:
+        return int(value) / 1000000
+    except ValueError:
+        return None
+
+
+progress_parsers = {'ffplay': parse_ffplay_line, 'ffmpeg': parse_ffmpeg_line}
+
+
+class ProgressReader:
+
+    def __init__(self, stream, kind, boundaries=None):
+        self.position = 0.0
+        self.first_audio_time = None
+        self.track_index = 0
+        self._stream = stream
+        self._parse = progress_parsers[kind]
+        self._boundaries = boundaries or []
+        self._events = []
+        self._lock = threading.Lock()
+        self._notify_r, self._notify_w = os.pipe()
+        os.set_blocking(self._notify_r, False)
+        self._thread = threading.Thread(target=self.__run, daemon=True)
+        self._thread.start()
+
+    def fileno(self):
+        return self._notify_r
+
+    def __notify(self, event):
+        with self._lock:
+            if self._notify_w is None:
+                return None
+            self._events.append(event)
+            try:
+                os.write(self._notify_w, b'\0')
+            except OSError:
+                pass
+
+    def __update(self, position):
+        self.position = position
+        if self.first_audio_time is None and position > 0:
+            self.first_audio_time = time.monotonic()
+            self.__notify(('first_audio', self.first_audio_time))
+            if self._boundaries:
+                self.__notify(('track', 0))
+        if not self._boundaries:
+            return None
+        index = max(bisect.bisect_right(self._boundaries, position) - 1, 0)
+        while self.track_index < index:
+            self.track_index += 1
+            self.__notify(('track', self.track_index))
+
+    def __run(self):
+        buffer = b''
+        while True:
+            chunk = self._stream.read1(4096)
+            if not chunk:
+                break
+            buffer += chunk
+            lines = re.split(rb'[\r\n]', buffer)
+            buffer = lines.pop()
+            for line in lines:
+                position = self._parse(line)
+                if position is not None:
+                    self.__update(position)
+        self._stream.close()
+
+    def pop_events(self):
+        with self._lock:
+            try:
+                os.read(self._notify_r, 4096)
+            except BlockingIOError:
+                pass
+            events, self._events = self._events, []
+        return events
+
+    def close(self):
+        with self._lock:
+            os.close(self._notify_r)
+            os.close(self._notify_w)
+            self._notify_w = None
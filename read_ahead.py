@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+from collections import OrderedDict
+
+
+class ReadAhead:
+
+    def __init__(self, budget: int = 32 * 1024 * 1024,
+                 chunk_size: int = 1024 * 1024, use_fadvise: bool = True):
+        self.budget = budget
+        self.chunk_size = chunk_size
+        self.use_fadvise = use_fadvise and hasattr(os, 'posix_fadvise')
+        self.warmed_bytes = 0
+        self._warmed = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._queue = []
+
+    def __advise(self, audio_file, length):
+        fd = os.open(audio_file, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+    def __read(self, audio_file, length):
+        with open(audio_file, 'rb', buffering=0) as fp:
+            while length > 0:
+                data = fp.read(min(self.chunk_size, length))
+                if not data:
+                    break
+                length -= len(data)
+
+    def __run(self):
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._thread = None
+                    return None
+                audio_file, length = self._queue.pop(0)
+            try:
+                self.__read(audio_file, length)
+            except OSError:
+                pass
+
+    def warm(self, audio_files):
+        budget = self.budget
+        queued = []
+        for audio_file in audio_files:
+            if budget <= 0:
+                break
+            try:
+                stat = os.stat(audio_file)
+            except OSError:
+                continue
+            length = min(stat.st_size, budget)
+            budget -= length
+            key = (audio_file, stat.st_mtime_ns)
+            if self._warmed.get(key, 0) >= length:
+                continue
+            self._warmed[key] = length
+            self._warmed.move_to_end(key)
+            while len(self._warmed) > 64:
+                self._warmed.popitem(last=False)
+            self.warmed_bytes += length
+            if self.use_fadvise:
+                try:
+                    self.__advise(audio_file, length)
+                    continue
+                except OSError:
+                    pass
+            queued.append((audio_file, length))
+        if not queued:
+            return None
+        with self._lock:
+            self._queue.extend(queued)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.__run,
+                                                daemon=True)
+                self._thread.start()
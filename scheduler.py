@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import shlex
+import datetime
+import argparse
+
+
+weekdays = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+
+def parse_time(input_string):
+    if input_string is None:
+        return None
+    fields = list(map(int, input_string.split(':')))
+    if not 2 <= len(fields) <= 3:
+        raise ValueError('Invalid time "{}", use HH:MM or HH:MM:SS'
+                         .format(input_string))
+    return datetime.time(*fields)
+
+
+def parse_days(input_string):
+    days = set()
+    for field in input_string.lower().split(','):
+        if field in ('*', 'daily'):
+            days.update(range(7))
+            continue
+        first, _, last = field.partition('-')
+        for name in (first, last or first):
+            if name[:3] not in weekdays:
+                raise ValueError('Invalid weekday "{}"'.format(name))
+        start = weekdays.index(first[:3])
+        stop = weekdays.index((last or first)[:3])
+        # ranges may wrap around the week, e.g. Sat-Mon
+        days.update((start + offset) % 7
+                    for offset in range((stop - start) % 7 + 1))
+    return days
+
+
+class ScheduleSlot:
+
+    def __init__(self, days, start, stop, path, options=None, line=0):
+        self.days = days
+        self.start = start
+        self.stop = stop
+        self.path = path
+        self.options = options or []
+        self.line = line
+
+    def __str__(self):
+        return '{} {}-{} {}'.format(
+                ','.join(weekdays[d].title() for d in sorted(self.days)),
+                self.start.strftime('%H:%M:%S'),
+                self.stop.strftime('%H:%M:%S'), self.path)
+
+    def intervals(self, date, count):
+        # [start, stop) datetimes on count days from date, a slot with
+        # stop <= start ends on the next day
+        for offset in range(count):
+            day = date + datetime.timedelta(days=offset)
+            if day.weekday() not in self.days:
+                continue
+            start = datetime.datetime.combine(day, self.start)
+            stop = datetime.datetime.combine(day, self.stop)
+            if stop <= start:
+                stop += datetime.timedelta(days=1)
+            yield start, stop
+
+
+def read_schedule(schedule_file):
+    # weekdays  start  stop  library path  [options]
+    directory = os.path.dirname(os.path.abspath(schedule_file))
+    slots = []
+    with open(schedule_file, 'r', encoding='utf-8') as fp:
+        for line_number, line in enumerate(fp, 1):
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+            try:
+                if len(fields) < 4:
+                    raise ValueError('Expected "WEEKDAYS START STOP PATH '
+                                     '[OPTIONS]"')
+                path = os.path.join(directory,
+                                    os.path.expanduser(fields[3]))
+                slots.append(ScheduleSlot(
+                        parse_days(fields[0]), parse_time(fields[1]),
+                        parse_time(fields[2]), os.path.normpath(path),
+                        fields[4:], line_number))
+            except ValueError as e:
+                raise ValueError('{}:{}: {}'.format(
+                    schedule_file, line_number, e))
+    return slots
+
+
+class SleepSchedule:
+
+    def __init__(self, windows=None, resync_interval=60.0):
+        # play windows as (start, stop) datetime.time pairs, a window with
+        # start > stop spans midnight and start == stop never sleeps
+        self.windows = [(start, stop) for start, stop in windows or []
+                        if start is not None]
+        self.resync_interval = resync_interval
+        # replaced to serve the control socket while sleeping
+        self.wait = time.sleep
+
+    @classmethod
+    def from_strings(cls, pairs, **kwargs):
+        return cls([(parse_time(start), parse_time(stop))
+                    for start, stop in pairs or []], **kwargs)
+
+    def __bool__(self):
+        return bool(self.windows)
+
+    def is_active(self, now=None):
+        if not self.windows:
+            return True
+        current_time = (now or datetime.datetime.now()).time()
+        for start, stop in self.windows:
+            if start < stop:
+                if start <= current_time < stop:
+                    return True
+            elif not stop <= current_time < start:
+                return True
+        return False
+
+    def is_sleeping(self, now=None):
+        return not self.is_active(now)
+
+    def next_boundary(self, now=None):
+        if not self.windows:
+            return None
+        now = now or datetime.datetime.now()
+        boundaries = []
+        for start, stop in self.windows:
+            for boundary in (start, stop):
+                target = datetime.datetime.combine(now.date(), boundary)
+                if target <= now:
+                    target += datetime.timedelta(days=1)
+                boundaries.append(target)
+        return min(boundaries)
+
+    def seconds_until_boundary(self, now=None):
+        now = now or datetime.datetime.now()
+        boundary = self.next_boundary(now)
+        if boundary is None:
+            return None
+        return (boundary - now).total_seconds()
+
+    def sleep_until(self, deadline):
+        # time.sleep runs on the monotonic clock; waking up at least every
+        # resync_interval re-reads the wall clock (NTP steps, suspend)
+        while True:
+            remaining = (deadline - datetime.datetime.now()).total_seconds()
+            if remaining <= 0:
+                return None
+            self.wait(min(remaining, self.resync_interval))
+
+    def sleep_until_active(self):
+        slept = 0.0
+        while self.is_sleeping():
+            start = time.monotonic()
+            self.sleep_until(self.next_boundary())
+            slept += time.monotonic() - start
+        return slept
+
+
+class WeeklySchedule(SleepSchedule):
+
+    def __init__(self, schedule_file, resync_interval=60.0):
+        super().__init__(None, resync_interval)
+        self.schedule_file = schedule_file
+        self.slots = []
+        # slot being played, the schedule sleeps once another slot (or no
+        # slot) becomes active
+        self.current = None
+        self._mtime = None
+        self.load()
+
+    def __bool__(self):
+        return bool(self.slots)
+
+    def load(self):
+        mtime = os.stat(self.schedule_file).st_mtime_ns
+        self.slots = read_schedule(self.schedule_file)
+        self._mtime = mtime
+
+    def reload(self):
+        try:
+            if os.stat(self.schedule_file).st_mtime_ns == self._mtime:
+                return False
+        except OSError:
+            return False
+        self.load()
+        return True
+
+    def __intervals(self, now):
+        # earlier lines win where slots overlap
+        date = now.date() - datetime.timedelta(days=1)
+        for slot in self.slots:
+            for start, stop in slot.intervals(date, 9):
+                yield slot, start, stop
+
+    def slot_at(self, now=None):
+        now = now or datetime.datetime.now()
+        for slot, start, stop in self.__intervals(now):
+            if start <= now < stop:
+                return slot
+        return None
+
+    def is_active(self, now=None):
+        slot = self.slot_at(now)
+        return slot is not None and self.current in (None, slot)
+
+    def changed(self, now=None):
+        return self.current is None or self.slot_at(now) is not self.current
+
+    def next_boundary(self, now=None):
+        now = now or datetime.datetime.now()
+        return min((edge for _, start, stop in self.__intervals(now)
+                    for edge in (start, stop) if edge > now), default=None)
+
+    def next_slot(self, now=None):
+        boundary = self.next_boundary(now)
+        if boundary is None:
+            return None
+        return self.slot_at(boundary)
+
+    def switch(self, now=None):
+        self.current = self.slot_at(now)
+        return self.current
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='scheduler',
+            description='Show the state and next boundary of play windows',
+            epilog='')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-t', '--timer', metavar=('START', 'STOP'), nargs=2,
+                       action='append',
+                       help='Play window as HH:MM[:SS] HH:MM[:SS], can be '
+                       'repeated')
+    group.add_argument('-s', '--schedule', type=str, metavar='FILE',
+                       help='Weekly schedule file of musicplayer --schedule')
+    args = parser.parse_args()
+
+    try:
+        if args.schedule is not None:
+            schedule = WeeklySchedule(args.schedule)
+            slot = schedule.switch()
+            print('Playing {}'.format(slot) if slot else 'Sleeping')
+            print('Next: {}'.format(schedule.next_slot() or 'sleep'))
+        else:
+            schedule = SleepSchedule.from_strings(args.timer)
+            print('Playing' if schedule.is_active() else 'Sleeping')
+        boundary = schedule.next_boundary()
+        print('Until {} ({:.0f} s)'.format(
+            boundary.strftime('%a %H:%M:%S'),
+            schedule.seconds_until_boundary()))
+    except KeyboardInterrupt:
+        print('Program interrupted')
+        raise SystemExit(0)
+    except Exception as e:
+        print('Exception encountered:', e)
+        raise SystemExit(1)
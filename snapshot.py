@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import hashlib
+import argparse
+
+
+snapshot_version = 3
+
+
+def process_start_time():
+    # monotonic time of the process start, so the import phase includes
+    # interpreter startup
+    try:
+        with open('/proc/self/stat', 'r') as fp:
+            fields = fp.read().rpartition(')')[2].split()
+        start = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+        return time.monotonic() - (
+                time.clock_gettime(time.CLOCK_BOOTTIME) - start)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def file_stats(filepath, files):
+    stats = []
+    for file in [''] + list(files) + ['favorites.txt']:
+        try:
+            stat = os.stat(os.path.join(filepath, file))
+            stats.append([file, stat.st_mtime_ns, stat.st_size])
+        except OSError:
+            stats.append([file, None, None])
+    return stats
+
+
+class StartupProfile:
+
+    def __init__(self):
+        self.start = process_start_time() or time.monotonic()
+        self.phases = {}
+        self.finished = False
+        self._last = self.start
+
+    def mark(self, phase):
+        # time since the previous mark is added to phase
+        if self.finished:
+            return None
+        now = time.monotonic()
+        self.phases[phase] = self.phases.get(phase, 0) \
+            + (now - self._last) * 1000
+        self._last = now
+
+    def finish(self, phase):
+        self.mark(phase)
+        self.finished = True
+
+    def total(self):
+        return sum(self.phases.values())
+
+    def fields(self):
+        fields = {'{}_ms'.format(phase.replace(' ', '_')): value
+                  for phase, value in self.phases.items()}
+        fields['total_ms'] = self.total()
+        return fields
+
+    def report(self):
+        return 'Startup: {}, total {:.0f} ms'.format(
+                ', '.join('{} {:.0f} ms'.format(phase, value)
+                          for phase, value in self.phases.items()),
+                self.total())
+
+
+class Snapshot:
+
+    def __init__(self, key, snapshot_file=None, persist=True):
+        if snapshot_file is None:
+            snapshot_file = os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    'snapshot.{}.json'.format(hashlib.sha1(
+                        key.encode()).hexdigest()[:12]))
+        self.key = key
+        self.snapshot_file = snapshot_file
+        self.persist = persist
+        self.restored = False
+        self.data = {}
+        if self.persist:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.snapshot_file, 'r', encoding='utf-8') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if data.get('version') == snapshot_version \
+                and data.get('key') == self.key:
+            self.data = data
+
+    def listing(self, filepath):
+        if self.data.get('path') != filepath:
+            return None
+        return self.data.get('listing')
+
+    def probes(self):
+        return self.data.get('probes', [])
+
+    def pop_stream(self, filepath, audio_files, genre_files):
+        # the saved cycle continues only on an identical library
+        data, self.data = self.data, {}
+        if data.get('path') != filepath \
+                or data.get('audio_files') != audio_files \
+                or data.get('genre_files') != genre_files \
+                or data.get('stats') != file_stats(filepath, genre_files):
+            return None
+        self.restored = True
+        return data.get('stream')
+
+    def save(self, filepath, audio_files, genre_files, listing, stream,
+             probes):
+        if not self.persist:
+            return None
+        temp_file = '{}.{}.tmp'.format(self.snapshot_file, os.getpid())
+        try:
+            with open(temp_file, 'w', encoding='utf-8') as fp:
+                json.dump({'version': snapshot_version, 'key': self.key,
+                           'saved': time.time(), 'path': filepath,
+                           'audio_files': audio_files,
+                           'genre_files': genre_files,
+                           'stats': file_stats(filepath, genre_files),
+                           'listing': listing, 'stream': stream,
+                           'probes': probes}, fp, separators=(',', ':'))
+            os.replace(temp_file, self.snapshot_file)
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='snapshot',
+            description='Show musicplayer warm-start snapshots', epilog='')
+    parser.add_argument('files', nargs='*', help='Snapshot files '
+                        '\"default = snapshot.*.json next to the scripts\"')
+    parser.add_argument('--clear', action='store_true',
+                        help='Remove the snapshot files')
+    args = parser.parse_args()
+
+    try:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        files = args.files or sorted(
+                os.path.join(directory, f) for f in os.listdir(directory)
+                if f.startswith('snapshot.') and f.endswith('.json'))
+        for file in files:
+            if args.clear:
+                os.remove(file)
+                continue
+            with open(file, 'r', encoding='utf-8') as fp:
+                data = json.load(fp)
+            stream = data.get('stream') or {}
+            print('{}: {} - {}, {} tracks, {} left in cycle, next {}'.format(
+                os.path.basename(file), time.strftime(
+                    '%D - %H:%M:%S', time.localtime(data.get('saved', 0))),
+                data.get('path'), len(data.get('audio_files') or []),
+                sum(s['remaining'] for s in stream.get('segments', []))
+                + len(stream.get('queue', []))
+                + len(stream.get('buffer', [])),
+                (stream.get('queue', []) + stream.get('buffer', []))[:3]))
+    except KeyboardInterrupt:
+        print('Program interrupted')
+        raise SystemExit(0)
+    except Exception as e:
+        print('Exception encountered:', e)
+        raise SystemExit(1)
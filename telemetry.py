@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import socket
+import argparse
+from collections import deque
+
+
+class Telemetry:
+
+    def __init__(self, stream_file, **session):
+        self.stream_file = stream_file
+        self.session = '{}-{}-{}'.format(
+                socket.gethostname(), os.getpid(), int(time.time()))
+        self.events = 0
+        self._fd = os.open(stream_file,
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.emit('session', host=socket.gethostname(), pid=os.getpid(),
+                  **session)
+
+    def emit(self, event, **fields):
+        if self._fd is None:
+            return None
+        record = {'ev': event, 't': round(time.monotonic(), 4),
+                  'wall': round(time.time(), 3), 'sid': self.session}
+        record.update((k, round(v, 2) if isinstance(v, float) else v)
+                      for k, v in fields.items() if v is not None)
+        # one write per record keeps lines whole with O_APPEND
+        try:
+            os.write(self._fd, (json.dumps(
+                record, separators=(',', ':')) + '\n').encode('utf-8'))
+            self.events += 1
+        except OSError:
+            pass
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class RollingHistogram:
+
+    bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self, size=512):
+        self.count = 0
+        self.samples = deque(maxlen=size)
+
+    def add(self, value):
+        self.count += 1
+        self.samples.append(value)
+
+    def percentile(self, percent):
+        return percentile(list(self.samples), percent)
+
+    def buckets(self):
+        counts = [0] * (len(self.bounds) + 1)
+        for value in self.samples:
+            index = 0
+            while index < len(self.bounds) and value > self.bounds[index]:
+                index += 1
+            counts[index] += 1
+        return counts
+
+    def format_buckets(self):
+        labels = ['<={}'.format(b) for b in self.bounds] \
+            + ['>{}'.format(self.bounds[-1])]
+        return ' '.join('{}:{}'.format(label, count) for label, count
+                        in zip(labels, self.buckets()) if count)
+
+
+class LatencyStats:
+
+    def __init__(self, size=512):
+        self.size = size
+        self.histograms = {}
+
+    def add(self, backend, name, value):
+        if value is None:
+            return None
+        key = (backend, name)
+        if key not in self.histograms:
+            self.histograms[key] = RollingHistogram(self.size)
+        self.histograms[key].add(value)
+
+    def summary(self, buckets=False):
+        lines = []
+        for (backend, name), histogram in sorted(self.histograms.items()):
+            lines.append('{} {}: {} samples, p50 {:.1f} ms, p90 {:.1f} ms, '
+                         'p99 {:.1f} ms, max {:.1f} ms'.format(
+                             backend, name, len(histogram.samples),
+                             histogram.percentile(50),
+                             histogram.percentile(90),
+                             histogram.percentile(99),
+                             max(histogram.samples)))
+            if buckets:
+                lines.append('    ' + histogram.format_buckets())
+        return lines
+
+
+def read_events(stream_files, event=None):
+    for stream_file in stream_files:
+        with open(stream_file, 'r', encoding='utf-8') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if event is None or record.get('ev') == event:
+                    yield record
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(records, fields, group_by=None):
+    groups = {}
+    for record in records:
+        key = record.get(group_by, '-') if group_by else 'all'
+        for field in fields:
+            value = record.get(field)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                groups.setdefault((str(key), field), []).append(value)
+    rows = []
+    for (key, field), values in sorted(groups.items()):
+        rows.append((key, field, len(values),
+                     percentile(values, 50), percentile(values, 90),
+                     percentile(values, 99), max(values)))
+    return rows
+
+
+def print_summary(rows):
+    print('{:<24} {:<10} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+        'group', 'field', 'count', 'p50', 'p90', 'p99', 'max'))
+    for key, field, count, p50, p90, p99, maximum in rows:
+        print('{:<24} {:<10} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'
+              .format(key[:24], field, count, p50, p90, p99, maximum))
+
+
+def print_slowest(records, field, count):
+    records = [r for r in records if isinstance(r.get(field), (int, float))]
+    records.sort(key=lambda r: r[field], reverse=True)
+    for record in records[:count]:
+        print('{:>9.1f} {} {}'.format(
+            record[field], time.strftime('%D - %H:%M:%S',
+                                         time.localtime(record['wall'])),
+            record.get('track', '')))
+
+
+def add_session_fields(records, fields=('backend', 'host')):
+    # session records carry backend and host once per invocation
+    sessions = {r.get('sid'): r for r in records if r.get('ev') == 'session'}
+    for record in records:
+        session = sessions.get(record.get('sid'), {})
+        for field in fields:
+            record.setdefault(field, session.get(field))
+    return records
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='telemetry',
+            description='Summarize musicplayer --telemetry streams',
+            epilog='')
+    parser.add_argument('files', nargs='+', help='JSONL telemetry files')
+    parser.add_argument('-e', '--event', type=str, default='end',
+                        help='Event to summarize: session, start, end, skip, '
+                        'probe, sleep, resume, slot, control, startup '
+                        '\"default = end\"')
+    parser.add_argument('-f', '--field', type=str, nargs='+',
+                        default=['probe_ms', 'spawn_ms', 'gap_ms', 'ttfa_ms'],
+                        help='Numeric fields to summarize')
+    parser.add_argument('-b', '--by', type=str, default='backend',
+                        help='Group by this field, e.g. backend, host, '
+                        'track, exit \"default = backend\"')
+    parser.add_argument('-s', '--slowest', type=int, default=0,
+                        metavar='N', help='List the N events with the '
+                        'highest value of the first field')
+    args = parser.parse_args()
+
+    try:
+        records = add_session_fields(list(read_events(args.files)))
+        records = [r for r in records if r.get('ev') == args.event]
+        if args.slowest > 0:
+            print_slowest(records, args.field[0], args.slowest)
+        else:
+            print_summary(summarize(records, args.field, args.by))
+    except KeyboardInterrupt:
+        print('Program interrupted')
+        raise SystemExit(0)
+    except Exception as e:
+        print('Exception encountered:', e)
+        raise SystemExit(1)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import fcntl
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import threading
+
+
+# ioctl number of FICLONE on Linux
+ficlone = 0x40049409
+
+
+def link_file(source, target, hardlink=False):
+    # a reflink shares the data copy-on-write and a copy also works across
+    # filesystems, a hard link shares the inode so an in-place edit of one
+    # file changes the cache object and every other output
+    try:
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), ficlone, src.fileno())
+        return 'reflink'
+    except OSError:
+        if os.path.exists(target):
+            os.remove(target)
+    if hardlink:
+        try:
+            os.link(source, target)
+            return 'hardlink'
+        except OSError:
+            pass
+    shutil.copyfile(source, target)
+    return 'copy'
+
+
+class TranscodeCache:
+
+    def __init__(self, cache_directory=None, max_size=4 << 30,
+                 hardlink=False):
+        if cache_directory is None:
+            cache_directory = os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    'transcode_cache')
+        self.cache_directory = os.path.abspath(cache_directory)
+        self.max_size = max_size
+        self.hardlink = hardlink
+        self.hits = 0
+        self.stored = 0
+        self.evicted = 0
+        self.saved = 0.0
+        self.links = {}
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is not None:
+            return self._db
+        os.makedirs(self.cache_directory, exist_ok=True)
+        self._db = sqlite3.connect(
+                os.path.join(self.cache_directory, 'index.db'), timeout=5,
+                check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+                'CREATE TABLE IF NOT EXISTS object ('
+                'key TEXT PRIMARY KEY, size INTEGER, encode_seconds REAL, '
+                'created REAL, last_used REAL, hits INTEGER)')
+        return self._db
+
+    @staticmethod
+    def key(source_hash, parameters):
+        # input content plus every encoder argument except the file names
+        return hashlib.sha1(json.dumps([source_hash, parameters]).encode(
+            'utf-8')).hexdigest()
+
+    def object_path(self, key):
+        return os.path.join(self.cache_directory, key[:2], key + '.mp3')
+
+    def contains(self, key):
+        return os.path.isfile(self.object_path(key))
+
+    def __detach(self, object_file):
+        # objects hard linked to outputs by earlier runs get their own inode
+        if self.hardlink or os.stat(object_file).st_nlink == 1:
+            return None
+        temp_file = '{}.{}.tmp'.format(object_file, os.getpid())
+        shutil.copyfile(object_file, temp_file)
+        os.replace(temp_file, object_file)
+
+    def fetch(self, key, target):
+        self.__detach(self.object_path(key))
+        method = link_file(self.object_path(key), target, self.hardlink)
+        with self._lock:
+            self.hits += 1
+            self.links[method] = self.links.get(method, 0) + 1
+            db = self._connect()
+            try:
+                row = db.execute('SELECT encode_seconds FROM object '
+                                 'WHERE key = ?', (key,)).fetchone()
+                db.execute('UPDATE object SET last_used = ?, '
+                           'hits = hits + 1 WHERE key = ?',
+                           (time.time(), key))
+                db.commit()
+                self.saved += row[0] if row else 0
+            except sqlite3.Error:
+                db.rollback()
+        return method
+
+    def store(self, key, output_file, encode_seconds):
+        object_file = self.object_path(key)
+        temp_file = '{}.{}.tmp'.format(object_file, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(object_file), exist_ok=True)
+            link_file(output_file, temp_file, self.hardlink)
+            os.replace(temp_file, object_file)
+            size = os.path.getsize(object_file)
+        except OSError:
+            return False
+        with self._lock:
+            db = self._connect()
+            try:
+                db.execute('INSERT OR REPLACE INTO object VALUES '
+                           '(?, ?, ?, ?, ?, 0)', (key, size, encode_seconds,
+                                                  time.time(), time.time()))
+                db.commit()
+                self.stored += 1
+            except sqlite3.Error:
+                db.rollback()
+                return False
+        self.evict()
+        return True
+
+    def evict(self):
+        # least recently used objects go first
+        with self._lock:
+            db = self._connect()
+            total = db.execute('SELECT COALESCE(SUM(size), 0) FROM object'
+                               ).fetchone()[0]
+            if total <= self.max_size:
+                return 0
+            evicted = []
+            for key, size in db.execute('SELECT key, size FROM object '
+                                        'ORDER BY last_used').fetchall():
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(self.object_path(key))
+                except OSError:
+                    pass
+                evicted.append((key,))
+                total -= size
+            db.executemany('DELETE FROM object WHERE key = ?', evicted)
+            db.commit()
+            self.evicted += len(evicted)
+        return len(evicted)
+
+    def totals(self):
+        with self._lock:
+            return self._connect().execute(
+                    'SELECT COUNT(*), COALESCE(SUM(size), 0), '
+                    'COALESCE(SUM(hits), 0), '
+                    'COALESCE(SUM(hits * encode_seconds), 0) FROM object'
+                    ).fetchone()
+
+    def stats(self):
+        return 'Transcode cache: {} encodes avoided ({:.2f} s saved{}), {} ' \
+            'stored, {} evicted'.format(
+                self.hits, self.saved, ''.join(
+                    ', {} {}'.format(count, method)
+                    for method, count in sorted(self.links.items())),
+                self.stored, self.evicted)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+            prog='transcode_cache',
+            description='Show the convert2mp3 transcode cache', epilog='')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Cache directory \"default = transcode_cache '
+                        'next to the scripts\"')
+    parser.add_argument('--max-size', type=int, default=None, metavar='MB',
+                        help='Evict least recently used objects down to MB')
+    args = parser.parse_args()
+
+    cache = TranscodeCache(args.cache_dir)
+    try:
+        if args.max_size is not None:
+            cache.max_size = args.max_size << 20
+            print('Evicted {} objects'.format(cache.evict()))
+        count, size, hits, saved = cache.totals()
+        print('{}: {} objects, {:.1f} MB, {} encodes avoided, {:.2f} s '
+              'saved'.format(cache.cache_directory, count, size / 2**20,
+                             hits, saved))
+    except KeyboardInterrupt:
+        print('Program interrupted')
+        raise SystemExit(0)
+    except Exception as e:
+        print('Exception encountered:', e)
+        raise SystemExit(1)
+    finally:
+        cache.close()
@@ -4,8 +4,7 @@ import os
 import argparse
 import time
 import subprocess
-from musicplayer import get_sleep_condition
-from musicplayer import format_str_time
+from scheduler import SleepSchedule
 
 
 def call_amixer_subprocess(current_volume):
@@ -41,8 +40,7 @@ def main():
     current_volume = int(subprocess.check_output(
         command, shell=True, text=True))
 
-    if not get_sleep_condition(
-            format_str_time(start_time), format_str_time(ramp_down_time)):
+    if schedule.is_active():
         current_volume = set_volume(min(
             current_volume+step_up, maximum_volume),
                                     current_volume, maximum_volume)
@@ -52,7 +50,8 @@ def main():
                                     minimum_volume)
 
     exit_func(exit_flag, current_volume, vol_dict.get(exit_flag))
-    time.sleep(interval)
+    # wake up exactly at the window boundary to start the next ramp
+    time.sleep(min(interval, schedule.seconds_until_boundary()))
 
 
 if __name__ == '__main__':
@@ -60,7 +59,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(
             prog='volume controller',
             description='Automatic system volume controller', epilog='')
-    parser.add_argument('time_window', nargs=2, help='\"HH:MM\" \"HH:MM\"')
+    parser.add_argument('time_window', nargs=2,
+                        help='\"HH:MM[:SS]\" \"HH:MM[:SS]\"')
     parser.add_argument('minimum_volume', type=int, help='Minimum volume')
     parser.add_argument('maximum_volume', type=int, help='Maximum volume')
     parser.add_argument('step_up', type=int, help='Volume step increase')
@@ -73,6 +73,7 @@ if __name__ == '__main__':
     command = 'amixer -D pulse sget Master | grep \'Right:\' | \
             awk -F\'[][]\' \'{ print $2 }\' | cut -d% -f1'
     start_time, ramp_down_time = args.time_window
+    schedule = SleepSchedule.from_strings([(start_time, ramp_down_time)])
     minimum_volume = args.minimum_volume
     maximum_volume = args.maximum_volume
     step_up = args.step_up